@@ -0,0 +1,174 @@
+import logging
+import time
+
+import metrics
+from ratelimit import TokenBucket
+
+# Commands whose duplicates from the same chat are merged while one is queued or running
+COALESCED_COMMANDS = frozenset({'summary', 'graph'})
+
+
+# Token buckets created on demand per key (user or chat). A bucket that has been idle long enough
+# to be full again is the same as a new one, so those are dropped from time to time.
+class _Buckets:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def prune(self, now):
+        idle = self.burst / self.rate
+        for key in [key for key, bucket in self._buckets.items() if now - bucket.updated > idle]:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Admission control in front of the handlers, checked by the update processor before an update
+# waits for its chat, so rejected updates cost a few dict lookups and never hold a slot:
+# - every user has a token bucket (`user_rate` updates per second, bursts of `user_burst`)
+# - every chat has one too (`chat_rate`, `chat_burst`), but only updates that ask for work (commands,
+#   +/- entries, files, buttons) from senders `authorized(update)` accepts take from it, so other
+#   members' chatter can't use up the admins' budget; a rate of 0 turns a limit off
+# - expensive commands additionally take a token from the user's bucket for expensive commands
+#   (`expensive_per_minute`, bursts of `expensive_burst`) and can't be repeated by the same user
+#   within `cooldown` seconds; `exempt_usernames` (the owners) skip these two checks
+# - an authorized /summary or /graph that is identical to one of the same chat that is still queued
+#   or running is dropped: the first one's answer covers it
+# Updates of unauthorized senders are only limited per user and otherwise left to the handlers, which
+# ignore them. Rejected authorized senders get at most one "slow down" notice per `notice_interval` seconds.
+class AdmissionControl:
+    def __init__(self, user_rate=1.0, user_burst=10, chat_rate=5.0, chat_burst=30, expensive_commands=frozenset(),
+                 expensive_per_minute=6, expensive_burst=3, cooldown=3.0, exempt_usernames=(), notice_interval=10.0,
+                 coalesced_commands=COALESCED_COMMANDS, authorized=None):
+        self._users = _Buckets(user_rate, user_burst) if user_rate > 0 else None
+        self._chats = _Buckets(chat_rate, chat_burst) if chat_rate > 0 else None
+        self._expensive = _Buckets(expensive_per_minute / 60, expensive_burst) if expensive_per_minute > 0 else None
+        self.expensive_commands = expensive_commands
+        self.coalesced_commands = coalesced_commands
+        self.cooldown = cooldown
+        self.exempt_usernames = frozenset(exempt_usernames)
+        self.notice_interval = notice_interval
+        self.authorized = authorized  # authorized(update) -> whether the sender may use the bot; None: everyone
+        self._last_used = {}  # (user ID, command) -> time it was last admitted
+        self._inflight = {}   # coalescing key -> number of identical updates admitted and not finished
+        self._noticed = {}    # user or chat ID -> time of the last notice
+        self._pruned = time.monotonic()
+        metrics.gauge('admission_tracked_users', lambda: len(self._users or ()), "Users with a flood-protection bucket")
+        metrics.gauge('admission_tracked_chats', lambda: len(self._chats or ()), "Chats with a flood-protection bucket")
+        metrics.gauge('admission_inflight_coalesced', lambda: len(self._inflight), "Distinct /summary and /graph requests queued or running")
+        metrics.describe('admission_admitted_total', "Updates let through to the handlers")
+        metrics.describe('admission_rejected_total', "Updates dropped by a rate limit or cooldown, by reason")
+        metrics.describe('admission_coalesced_total', "Duplicate /summary, /graph and button requests merged into one still running")
+
+    # Seconds left before a user may run a command again (0 when the cooldown is over)
+    def _cooldown_left(self, key, now):
+        last = self._last_used.get(key)
+        return 0 if last is None else max(0, self.cooldown - (now - last))
+
+    # Commands, +/- entries, files and buttons; everything else is chatter the handlers ignore
+    @staticmethod
+    def _asks_for_work(update):
+        if update.callback_query is not None:
+            return True
+        message = update.effective_message
+        return message is not None and (message.document is not None or (message.text or '')[:1] in ('/', '+', '-'))
+
+    def _is_authorized(self, update):
+        return self.authorized is None or self.authorized(update)
+
+    def _prune(self, now):
+        for buckets in (self._users, self._chats, self._expensive):
+            if buckets is not None:
+                buckets.prune(now)
+        for store, age in ((self._last_used, self.cooldown), (self._noticed, self.notice_interval)):
+            for key in [key for key, when in store.items() if now - when > age]:
+                del store[key]
+        self._pruned = now
+
+    # Decide whether an update may run. `command` is the update's command name (None for other updates).
+    # Returns (reason, key): reason is None when admitted, otherwise 'user', 'chat', 'expensive', 'cooldown'
+    # or 'duplicate'; key is the coalescing key to pass to release() once an admitted update is done.
+    def admit(self, update, command=None):
+        now = time.monotonic()
+        if now - self._pruned > 60:
+            self._prune(now)
+        user = update.effective_user
+        chat = update.effective_chat
+
+        if self._users is not None and user is not None and not self._users.get(user.id).try_acquire():
+            return self._reject('user')
+        if not self._asks_for_work(update) or not self._is_authorized(update):
+            metrics.inc('admission_admitted_total')
+            return None, None
+        if self._chats is not None and chat is not None and not self._chats.get(chat.id).try_acquire():
+            return self._reject('chat')
+
+        key = None
+        message = update.effective_message
+        if command in self.coalesced_commands and chat is not None and message is not None and message.text:
+            key = (chat.id, command, tuple(message.text.split()[1:]))
+        elif update.callback_query is not None and chat is not None:
+            key = (chat.id, 'callback', update.callback_query.data)
+        if key is not None and key in self._inflight:
+            metrics.inc('admission_coalesced_total', (('command', command or 'callback'),))
+            return 'duplicate', None
+
+        if command in self.expensive_commands and user is not None and user.username not in self.exempt_usernames:
+            if self._cooldown_left((user.id, command), now):
+                return self._reject('cooldown')
+            if self._expensive is not None and not self._expensive.get(user.id).try_acquire():
+                return self._reject('expensive')
+            self._last_used[(user.id, command)] = now
+
+        if key is not None:
+            self._inflight[key] = self._inflight.get(key, 0) + 1
+        metrics.inc('admission_admitted_total')
+        return None, key
+
+    def _reject(self, reason):
+        metrics.inc('admission_rejected_total', (('reason', reason),))
+        return reason, None
+
+    # Call when an admitted update with a coalescing key has been handled
+    def release(self, key):
+        count = self._inflight.get(key, 0) - 1
+        if count > 0:
+            self._inflight[key] = count
+        else:
+            self._inflight.pop(key, None)
+
+    # Tell the sender why an update was dropped (an admit() reason, or 'backlog' when the update processor
+    # dropped it because its chat had too many updates waiting), at most once per notice_interval.
+    # Only updates the bot would have answered (commands, entries, files, buttons of authorized senders)
+    # get a notice; duplicates never do.
+    async def notify(self, update, reason, command=None):
+        if reason == 'duplicate' or not self._asks_for_work(update) or not self._is_authorized(update):
+            return
+        user = update.effective_user
+        target = user.id if user is not None else (update.effective_chat.id if update.effective_chat is not None else None)
+        now = time.monotonic()
+        if target is None or now - self._noticed.get(target, -self.notice_interval) < self.notice_interval:
+            return
+
+        if reason in ('cooldown', 'expensive'):
+            text = f"Please wait a few seconds before using /{command} again."
+        elif reason == 'backlog':
+            text = "Still busy with this chat's earlier messages: this one was not processed, please send it again in a moment."
+        else:
+            text = "Too many messages at once: this one was not processed, please slow down."
+        self._noticed[target] = now
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text)
+            else:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logging.debug(f"Failed to send admission notice to {target}: {str(e)}")
@@ -0,0 +1,59 @@
+import logging
+
+
+# In-memory copy of who is allowed to use the bot: the admin chat/user IDs from the users table
+# and the owner usernames. Loaded once at startup and reloaded explicitly by the commands that
+# change admin status, so checking (and rejecting) a message never has to query SQLite.
+class AuthCache:
+    def __init__(self, db, owner_usernames):
+        self.db = db
+        self.owner_usernames = frozenset(owner_usernames)
+        self._admin_ids = None  # None until loaded
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _store(self, rows):
+        self._admin_ids = frozenset(row[0] for row in rows)
+        self.reloads += 1
+
+    # Blocking initial load, for use at startup before the event loop runs
+    def load_sync(self):
+        self._store(self.db.run_sync(lambda conn: conn.execute("SELECT chat_id FROM users WHERE is_admin = 1").fetchall()))
+
+    # Reload the admin IDs from the database
+    async def reload(self):
+        self._store(await self.db.fetchall("SELECT chat_id FROM users WHERE is_admin = 1"))
+
+    # Drop the cached admin IDs and load them again (call after every change to users.is_admin or the users table)
+    async def invalidate(self):
+        self._admin_ids = None
+        try:
+            await self.reload()
+        except Exception as e:
+            # The next lookup will retry the load
+            logging.error(f"Failed to reload the authorization cache: {str(e)}")
+
+    def is_owner(self, username):
+        return username in self.owner_usernames
+
+    async def is_admin(self, chat_id):
+        if self._admin_ids is None:
+            self.misses += 1
+            await self.reload()
+        else:
+            self.hits += 1
+        return chat_id in self._admin_ids
+
+    # Admin check without a database round trip, for the admission control; None while the IDs aren't loaded
+    def is_admin_cached(self, chat_id):
+        return None if self._admin_ids is None else chat_id in self._admin_ids
+
+    def stats(self):
+        return {
+            'admins': len(self._admin_ids) if self._admin_ids is not None else None,
+            'owners': len(self.owner_usernames),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+        }
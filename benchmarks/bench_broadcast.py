@@ -0,0 +1,72 @@
+# Broadcast engine against the fake Bot: latency, 429s, failing chats and an interrupted job that is resumed.
+#
+#   python benchmarks/bench_broadcast.py [--chats N] [--rate R] [--concurrency C]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations  # noqa: E402
+from broadcast import BroadcastEngine  # noqa: E402
+from fake_telegram import FakeBot  # noqa: E402
+from storage import Storage  # noqa: E402
+
+ADMIN_CHAT_ID = 1
+
+
+def populate(db, chats):
+    def insert(conn):
+        conn.executemany("INSERT INTO users (chat_id, username) VALUES (?, ?)", [(chat_id, f"user{chat_id}") for chat_id in range(2, chats + 2)])
+    db.run_sync(insert)
+
+
+async def run(args, db):
+    bot = FakeBot(latency=args.latency, rate_limit=args.telegram_limit, fail_chat_ids=range(2, 2 + args.failing))
+    engine = BroadcastEngine(db, rate=args.rate, concurrency=args.concurrency, progress_interval=0.5)
+
+    started = time.monotonic()
+    job_id = await engine.start(bot, ADMIN_CHAT_ID, "Hello from the benchmark")
+
+    # Interrupt the job halfway through, as a restart would, then resume it with a new engine
+    await asyncio.sleep(args.chats / args.rate / 2)
+    await engine.stop()
+    interrupted_at = len(bot.sent)
+
+    engine = BroadcastEngine(db, rate=args.rate, concurrency=args.concurrency, progress_interval=0.5)
+    await engine.resume(bot)
+    await engine.wait()
+    elapsed = time.monotonic() - started
+
+    delivered = [chat_id for chat_id, _ in bot.sent if chat_id != ADMIN_CHAT_ID]
+    print(f"job #{job_id}: {len(delivered)} delivered ({len(set(delivered))} unique) to {args.chats} chats in {elapsed:.2f}s")
+    print(f"interrupted after {interrupted_at} sends, resumed without duplicates: {len(delivered) == len(set(delivered))}")
+    print(f"429 answers from the fake API: {bot.flood_errors}, retries by the engine: {engine.retries}")
+    print(f"progress edits: {len(bot.edits)}, final: {bot.edits[-1][2] if bot.edits else None!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=25)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--telegram-limit', type=int, default=20, help="messages/s the fake API accepts before answering 429")
+    parser.add_argument('--failing', type=int, default=3, help="number of chats that always fail")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Storage(os.path.join(tmp, 'bench.db'))
+        try:
+            migrations.migrate(db)
+            populate(db, args.chats)
+            asyncio.run(run(args, db))
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Micro-benchmark: per-message cost of evaluating an entry with the old regex + eval() path
+# versus expression.evaluate(), both with a cold cache and with the repeated entries a team sends.
+#
+#   python benchmarks/bench_expression.py [--number N]
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import expression  # noqa: E402
+
+SAMPLES = ["+20*5", "-10/2", "+150", "-(12.5+7.5)*3", "+1000/4-20", "+99.99", "-3*(4+5)/2", "+250 coffee"]
+
+
+def old_path(text):
+    return eval(re.sub(r'[^0-9\.\+\-\*/\(\) ]', '', text))
+
+
+def new_path(text):
+    return expression.evaluate(expression.clean(text))
+
+
+def new_path_cold(text):
+    expression.cache_clear()
+    return expression.evaluate(expression.clean(text))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for text in SAMPLES:
+        assert abs(old_path(text) - new_path(text)) < 1e-9, text
+
+    for name, fn in (("eval()", old_path), ("evaluate, cold cache", new_path_cold), ("evaluate, warm cache", new_path)):
+        seconds = timeit.timeit(lambda: [fn(text) for text in SAMPLES], number=args.number)
+        per_message = seconds / (args.number * len(SAMPLES)) * 1e6
+        print(f"{name:<22} {per_message:8.2f} us/message")
+
+    # The input that used to freeze the bot is now rejected up front
+    seconds = timeit.timeit(lambda: _rejected("+9**9**9"), number=args.number)
+    print(f"{'reject +9**9**9':<22} {seconds / args.number * 1e6:8.2f} us/message")
+
+
+def _rejected(text):
+    try:
+        new_path(text)
+    except expression.ExpressionError:
+        return True
+    return False
+
+
+if __name__ == '__main__':
+    main()
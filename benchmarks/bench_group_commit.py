@@ -0,0 +1,103 @@
+# Insert throughput of the bot's original path (one shared connection with the default rollback journal,
+# INSERT and commit() per message on the event loop), of one writer-thread transaction per message and
+# of the group-commit writer. Many chats submit entries concurrently, as they do during rush hours.
+# Every path fsyncs its commits unless --synchronous says otherwise.
+#
+#   python benchmarks/bench_group_commit.py [--entries N] [--chats C] [--interval-ms MS] [--batch-size B] [--synchronous FULL]
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ledger  # noqa: E402
+import migrations  # noqa: E402
+from storage import GroupCommitWriter, Storage  # noqa: E402
+
+
+# What the bot did before the storage layer: every entry blocks the loop for its own commit
+def original(path, entries, synchronous):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+        started = time.perf_counter()
+        for chat_id, amount, day, category in entries:
+            conn.execute('INSERT INTO transactions (amount, day, category, chat_id) VALUES (?, ?, ?, ?)', (amount, day, category, chat_id))
+            conn.commit()
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+# One entry with its running and daily totals, the way the bot wrote them before group commit
+def add_transaction(conn, chat_id, amount, day, category):
+    cursor = conn.execute('INSERT INTO transactions (amount, day, category, chat_id) VALUES (?, ?, ?, ?)', (amount, day, category, chat_id))
+    conn.execute('''INSERT INTO chat_totals (chat_id, total, count, last_activity, last_id) VALUES (?, ?, 1, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET total = total + excluded.total,
+                                                       count = count + 1,
+                                                       last_activity = excluded.last_activity,
+                                                       last_id = excluded.last_id''',
+                 (chat_id, amount, int(time.time()), cursor.lastrowid))
+    conn.execute('''INSERT INTO daily_totals (chat_id, day, sum, count) VALUES (?, ?, ?, 1)
+                    ON CONFLICT(chat_id, day) DO UPDATE SET sum = sum + excluded.sum, count = count + 1''',
+                 (chat_id, day, amount))
+    return conn.execute('SELECT total FROM chat_totals WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+
+
+async def per_message(db, entries):
+    async def one(entry):
+        chat_id, amount, day, category = entry
+        return await db.transaction(add_transaction, chat_id, amount, day, category)
+    return await asyncio.gather(*(one(entry) for entry in entries))
+
+
+async def group_commit(db, entries, interval, batch_size):
+    writer = GroupCommitWriter(db, ledger.add_transactions, flush_interval=interval, batch_size=batch_size)
+    results = await asyncio.gather(*(writer.submit(entry) for entry in entries))
+    await writer.close()
+    print(f"  {writer.batches} batches, {writer.items / max(writer.batches, 1):.1f} entries per commit")
+    return results
+
+
+def run(name, path, coroutine_factory, entries, synchronous):
+    db = Storage(path, synchronous=synchronous)
+    try:
+        migrations.migrate(db)
+        started = time.perf_counter()
+        asyncio.run(coroutine_factory(db))
+        elapsed = time.perf_counter() - started
+        mismatches = db.run_sync(ledger.verify_totals)
+    finally:
+        db.close()
+    print(f"{name:<18} {entries / elapsed:10.0f} inserts/s  ({elapsed:.2f}s, totals in sync: {not mismatches})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--interval-ms', type=float, default=5)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--synchronous', default='FULL', help="PRAGMA synchronous for every path")
+    args = parser.parse_args()
+
+    entries = [(i % args.chats, float(i % 50 - 20), 20240101, 'general') for i in range(args.entries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'original.db')
+        db = Storage(path)
+        migrations.migrate(db)
+        db.close()
+        elapsed = original(path, entries, args.synchronous)
+        print(f"{'original':<18} {args.entries / elapsed:10.0f} inserts/s  ({elapsed:.2f}s)")
+        run("per-message commit", os.path.join(tmp, 'single.db'), lambda db: per_message(db, entries), args.entries, args.synchronous)
+        run("group commit", os.path.join(tmp, 'group.db'),
+            lambda db: group_commit(db, entries, args.interval_ms / 1000, args.batch_size), args.entries, args.synchronous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Bulk import speed: parse an /export-style CSV of N rows (plain and gzip) and insert it with one
+# ledger.add_transactions transaction, as an uploaded file is handled; also a multi-line message of entries.
+#
+#   python benchmarks/bench_ingest.py [--rows N]
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingest  # noqa: E402
+import ledger  # noqa: E402
+import migrations  # noqa: E402
+from storage import Storage  # noqa: E402
+
+
+def make_csv(rows):
+    lines = ["ID,Amount,Date,Category,Chat ID"]
+    lines += [f"{i},{(i % 200 - 100) / 4},2024-{i % 12 + 1:02d}-{i % 28 + 1:02d},cat{i % 7},1" for i in range(1, rows + 1)]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def timed(label, fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    print(f"{label:<28} {time.perf_counter() - started:8.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    data = make_csv(args.rows)
+    compressed = gzip.compress(data)
+    print(f"{args.rows} rows, {len(data) / 1e6:.1f} MB CSV, {len(compressed) / 1e6:.1f} MB gzip")
+    today = ledger.today()
+    batch = timed("parse csv", ingest.parse_upload, data, 'import.csv', 1, today, args.rows)
+    timed("parse csv.gz", ingest.parse_upload, compressed, 'import.csv.gz', 1, today, args.rows)
+    message = "\n".join(f"+{i % 50}*2 cat{i % 7} 2024-05-{i % 28 + 1:02d}" for i in range(2000))
+    timed("parse 2000-line message", ingest.parse_lines, message, 1, today)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Storage(os.path.join(tmp, 'ingest.db'))
+        try:
+            migrations.migrate(db)
+            totals = timed("insert (one transaction)", db.run_sync, ledger.add_transactions, batch.entries)
+            print(f"imported {len(totals)} rows, {batch.rejected} rejected, total {totals[-1]}, "
+                  f"totals in sync: {not db.run_sync(ledger.verify_totals)}")
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
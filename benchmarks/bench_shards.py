@@ -0,0 +1,70 @@
+# Insert throughput of the ledger backend with 1, 2, 4 and 8 shards.
+# Many chats submit entries concurrently; each shard has its own writer thread and group-commit queue.
+# --batch-size 1 commits every entry on its own, which makes the writer the bottleneck.
+#
+#   python benchmarks/bench_shards.py [--entries N] [--chats C] [--shards 1,2,4,8] [--batch-size B]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ledger  # noqa: E402
+import migrations  # noqa: E402
+import sharding  # noqa: E402
+from storage import Storage  # noqa: E402
+
+
+async def submit_all(backend, entries, concurrency):
+    queue = iter(entries)
+    started = time.perf_counter()
+
+    async def worker():
+        for entry in queue:
+            await backend.submit(entry)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    # Every submit resolved after its commit, so the totals can be checked right away
+    mismatches = sum(len(shard) for shard in await backend.read_all(ledger.verify_totals))
+    await backend.close()
+    return elapsed, mismatches
+
+
+def run(tmp, shards, entries, args):
+    main_path = os.path.join(tmp, f"main{shards}.db")
+    db = Storage(main_path)
+    try:
+        migrations.migrate(db)
+        if shards > 1:
+            backend = sharding.ShardedBackend(db, sharding.shard_paths(main_path, shards), flush_interval=args.interval_ms / 1000, batch_size=args.batch_size)
+        else:
+            backend = sharding.LedgerBackend(db, flush_interval=args.interval_ms / 1000, batch_size=args.batch_size)
+        backend.migrate()
+        elapsed, mismatches = asyncio.run(submit_all(backend, entries, args.concurrency))
+    finally:
+        db.close()
+    print(f"{shards} shard(s): {len(entries) / elapsed:10.0f} inserts/s  ({elapsed:.2f}s, totals in sync: {not mismatches})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=500, help="entries in flight at once")
+    parser.add_argument('--shards', default='1,2,4,8')
+    parser.add_argument('--interval-ms', type=float, default=5)
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    entries = [(i % args.chats, float(i % 50 - 20), 20240101, 'general') for i in range(args.entries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in (int(value) for value in args.shards.split(',')):
+            run(tmp, shards, entries, args)
+
+
+if __name__ == '__main__':
+    main()
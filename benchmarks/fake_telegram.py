@@ -0,0 +1,70 @@
+# A local stand-in for telegram.Bot, for benchmarks and load tests.
+# It adds a configurable latency to every call, enforces a global messages-per-second limit
+# the way Telegram does (answering with RetryAfter when it is exceeded) and records what was sent.
+import asyncio
+import itertools
+import random
+import time
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, RetryAfter
+
+
+class FakeBot:
+    def __init__(self, latency=0.05, jitter=0.02, rate_limit=30, retry_after=1, fail_chat_ids=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.fail_chat_ids = set(fail_chat_ids)
+        self.sent = []
+        self.edits = []
+        self.documents = []
+        self.photos = []
+        self.flood_errors = 0
+        self._window = []
+        self._message_ids = itertools.count(1)
+
+    async def _delay(self):
+        await asyncio.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def _check_flood(self):
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        self._window = [t for t in self._window if now - t < 1]
+        if len(self._window) >= self.rate_limit:
+            self.flood_errors += 1
+            raise RetryAfter(self.retry_after)
+        self._window.append(now)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._delay()
+        self._check_flood()
+        if chat_id in self.fail_chat_ids:
+            raise BadRequest("Chat not found")
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._delay()
+        self.edits.append((chat_id, message_id, text))
+        return True
+
+    async def get_chat(self, chat_id):
+        await self._delay()
+        if chat_id in self.fail_chat_ids:
+            raise BadRequest("Chat not found")
+        return SimpleNamespace(id=chat_id, title=f"Chat {chat_id}", username=None)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._delay()
+        data = document.read() if hasattr(document, 'read') else document
+        self.documents.append((chat_id, kwargs.get('filename'), len(data) if data is not None else 0))
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._delay()
+        data = photo.read() if hasattr(photo, 'read') else photo
+        self.photos.append((chat_id, len(data) if data is not None else 0))
+        return SimpleNamespace(message_id=next(self._message_ids))
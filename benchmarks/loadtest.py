@@ -0,0 +1,190 @@
+# Load test: drives the real handlers in bot.py with real telegram.Update objects against the
+# fake Bot from fake_telegram.py and a temporary database, and reports throughput and per-handler
+# latency percentiles as JSON. With --admission the bot's admission control sits in front of the
+# handlers, and --flood-ratio adds one user flooding one chat to see what it lets through.
+#
+#   python benchmarks/loadtest.py [--chats 2000] [--updates 20000] [--concurrency 64] [--output results.json]
+#   python benchmarks/loadtest.py --admission --flood-ratio 0.2
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from admission import AdmissionControl  # noqa: E402
+from dispatch import HEAVY_COMMANDS, ChatUpdateProcessor  # noqa: E402
+from fake_telegram import FakeBot  # noqa: E402
+
+OWNER_USERNAME = 'mada167'
+ENTRIES = ["+20*5", "-10/2", "+150", "-(12.5+7.5)*3", "+1000/4-20", "+99.99", "-3*(4+5)/2", "+250 coffee"]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def make_update(bot, update_id, chat_id, user_id, username, text, chat_type='group'):
+    from telegram import Update
+
+    chat = {'id': chat_id, 'type': chat_type}
+    if chat_type != 'private':
+        chat['title'] = f"Chat {chat_id}"
+    data = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+# Synthetic workload: mostly +/- entries from chat admins, some messages from non-admins that must be
+# rejected, and a few heavy commands from the owner
+def build_workload(args, rng):
+    workload = []
+    heavy = [('summary', '/summary'), ('export', '/export'), ('graph', '/graph')]
+    for _ in range(args.updates):
+        chat_id = -1000 - rng.randrange(args.chats)
+        roll = rng.random()
+        if roll < args.heavy_ratio:
+            name, text = rng.choice(heavy)
+            workload.append((name, chat_id, 1, OWNER_USERNAME, text))
+        elif roll < args.heavy_ratio + args.flood_ratio:
+            # One admin of the first chat sending entries as fast as possible
+            workload.append(('flood', -1000, 1000, 'admin1000', rng.choice(ENTRIES)))
+        elif roll < args.heavy_ratio + args.flood_ratio + args.reject_ratio:
+            workload.append(('rejected', chat_id, 10_000_000 + rng.randrange(args.chats), 'stranger', rng.choice(ENTRIES)))
+        else:
+            admin_id = -chat_id
+            workload.append(('handle_message', chat_id, admin_id, f"admin{admin_id}", rng.choice(ENTRIES)))
+    return workload
+
+
+def setup_database(bot_module, chats):
+    def insert(conn):
+        conn.executemany("INSERT OR IGNORE INTO users (chat_id, username, is_admin, chat_type) VALUES (?, ?, 1, 'private')",
+                         [(1000 + i, f"admin{1000 + i}") for i in range(chats)])
+    bot_module.db.run_sync(insert)
+    bot_module.auth_cache.load_sync()
+
+
+async def run(args, bot_module, workload):
+    fake_bot = FakeBot(latency=args.latency, jitter=args.latency / 2, rate_limit=0)
+    handlers = {
+        'handle_message': bot_module.handle_message,
+        'rejected': bot_module.handle_message,
+        'flood': bot_module.handle_message,
+        'summary': bot_module.summary_command,
+        'export': bot_module.export_transactions,
+        'graph': bot_module.send_graph,
+    }
+    latencies = {name: [] for name in handlers}
+    errors = {name: 0 for name in handlers}
+    handled = {name: 0 for name in handlers}
+    # Same scheduling as the bot: per-chat ordering, bounded normal and heavy lanes, and with --admission its default limits
+    admission = AdmissionControl(expensive_commands=HEAVY_COMMANDS, exempt_usernames=[OWNER_USERNAME],
+                                 authorized=bot_module.may_use_bot) if args.admission else None
+    processor = ChatUpdateProcessor(concurrency=args.concurrency, heavy_concurrency=args.heavy_concurrency, max_pending=args.updates,
+                                    admission=admission)
+
+    async def handle(name, update, context):
+        handled[name] += 1
+        try:
+            await handlers[name](update, context)
+        except Exception:
+            errors[name] += 1
+
+    # Latency is measured from arrival, so it includes waiting for the chat and for a lane
+    async def dispatch(update_id, name, chat_id, user_id, username, text):
+        update = make_update(fake_bot, update_id, chat_id, user_id, username, text)
+        context = SimpleNamespace(bot=fake_bot, args=text.split()[1:] if text.startswith('/') else [])
+        started = time.perf_counter()
+        await processor.process_update(update, handle(name, update, context))
+        latencies[name].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(dispatch(update_id, *item) for update_id, item in enumerate(workload, 1)))
+    elapsed = time.perf_counter() - started
+    await bot_module.ledger_backend.close()
+
+    return {
+        'updates': len(workload),
+        'chats': args.chats,
+        'concurrency': args.concurrency,
+        'heavy_concurrency': args.heavy_concurrency,
+        'api_latency_s': args.latency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_updates_per_s': round(len(workload) / elapsed, 1),
+        'handlers': {
+            name: {
+                'count': len(values),
+                'handled': handled[name],
+                'errors': errors[name],
+                'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None,
+                'max_ms': round(max(values) * 1000, 3) if values else None,
+            }
+            for name, values in latencies.items()
+        },
+        'replies_sent': len(fake_bot.sent),
+        'documents_sent': len(fake_bot.documents),
+        'photos_sent': len(fake_bot.photos),
+        'admission': {f"{name}{dict(labels) if labels else ''}": value
+                      for (name, labels), value in sorted(metrics._counters.items()) if name.startswith('admission_')},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64, help="updates handled at once in the normal lane")
+    parser.add_argument('--heavy-concurrency', type=int, default=4, help="heavy commands handled at once")
+    parser.add_argument('--heavy-ratio', type=float, default=0.002, help="share of /summary, /export and /graph")
+    parser.add_argument('--reject-ratio', type=float, default=0.2, help="share of messages from non-admins")
+    parser.add_argument('--flood-ratio', type=float, default=0.0, help="share of messages from one admin flooding one chat")
+    parser.add_argument('--admission', action='store_true', help="put the bot's admission control in front of the handlers")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated Telegram API latency in seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py reads its configuration from the environment; point it at a throwaway database
+        os.environ['TRANSACTIONS_DB'] = os.path.join(tmp, 'loadtest.db')
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:loadtest')
+        import bot
+
+        bot.init_database()
+        try:
+            setup_database(bot, args.chats)
+            workload = build_workload(args, random.Random(args.seed))
+            results = asyncio.run(run(args, bot, workload))
+        finally:
+            bot.graph_renderer.shutdown()
+            bot.db.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Replays recorded Telegram updates against a bot running in webhook mode, the way Telegram would
+# post them, and reports the HTTP status codes and the time the webhook took to accept each update.
+# Updates are read from a JSON file (a list of updates, or one update per line); without a file,
+# --synthetic N private-chat "+1" messages from the first owner are generated.
+#
+#   WEBHOOK_URL=https://example.org/telegram WEBHOOK_SECRET=s3cret python bot.py
+#   python benchmarks/replay_updates.py --url http://127.0.0.1:8443/telegram --secret s3cret [updates.json]
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+OWNER_USERNAME = 'mada167'
+
+
+def load_updates(path):
+    with open(path) as file:
+        text = file.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def synthetic_updates(count):
+    now = int(time.time())
+    return [{
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': now,
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': OWNER_USERNAME, 'username': OWNER_USERNAME},
+            'text': '+1',
+        },
+    } for update_id in range(1, count + 1)]
+
+
+async def replay(args, updates):
+    statuses = {}
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'updates': len(updates),
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(len(updates) / elapsed, 1) if elapsed else None,
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3) if latencies else None,
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', help="recorded updates (JSON list or one JSON update per line)")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', help="value of WEBHOOK_SECRET")
+    parser.add_argument('--synthetic', type=int, default=100, help="number of updates to generate when no file is given")
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.synthetic)
+    print(json.dumps(asyncio.run(replay(args, updates)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,183 @@
+import time
+
+# Taken before the remaining imports, for --startup-time
+STARTED = time.perf_counter()
+
+import argparse
+import asyncio
 import os
-import sqlite3
-from datetime import datetime
-import csv
-import matplotlib.pyplot as plt
+import resource
+import sys
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from telegram.constants import ParseMode
+from telegram.error import BadRequest
 import logging
-import re
-
-# Setup logging for better debugging and monitoring
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-
-# Connect to the SQLite database
-conn = sqlite3.connect('transactions.db')
-c = conn.cursor()
-
-# Add is_admin column to the users table if it doesn't exist
-try:
-    c.execute("ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT 0")
-except sqlite3.OperationalError:
-    # Ignore if the column already exists
-    pass
-
-# Ensure that the users and transactions tables exist to store user chat IDs, usernames, and transaction details
-c.execute('''CREATE TABLE IF NOT EXISTS users
-             (chat_id INTEGER PRIMARY KEY, 
-              username TEXT, 
-              is_admin BOOLEAN DEFAULT 0, 
-              chat_type TEXT)''')
-
-c.execute('''CREATE TABLE IF NOT EXISTS transactions
-             (id INTEGER PRIMARY KEY, 
-              amount REAL, 
-              date TEXT, 
-              category TEXT, 
-              chat_id INTEGER)''')
-
-c.execute('''CREATE TABLE IF NOT EXISTS report_times
-             (chat_id INTEGER PRIMARY KEY, 
-              hour INTEGER, 
-              minute INTEGER)''')
-
-conn.commit()
-
-# Add chat_type column to the users table if it doesn't exist
-try:
-    c.execute("ALTER TABLE users ADD COLUMN chat_type TEXT DEFAULT 'private'")
-except sqlite3.OperationalError:
-    # Ignore if the column already exists
-    pass
-
-# Load Telegram bot token from environment variables for security
+import export
+import expression
+import graphs
+import ingest
+import ledger
+import metrics
+import migrations
+import retention
+import sharding
+import summary
+from auth import AuthCache
+from broadcast import BroadcastEngine
+from chat_meta import ChatMetaCache
+from reports import ReportScheduler
+from storage import Storage
+
+# Path to the SQLite database (can be overridden, e.g. to run against a copy)
+DB_PATH = os.getenv('TRANSACTIONS_DB', 'transactions.db')
+
+# Open the async storage layer: a dedicated writer thread plus a small pool of readers, all in WAL mode.
+# Every commit is fsynced (DB_SYNCHRONOUS=FULL); NORMAL is faster but a power loss can undo confirmed entries.
+db = Storage(DB_PATH, synchronous=os.getenv('DB_SYNCHRONOUS', 'FULL'))
+
+# Load Telegram bot token from environment variables for security (checked in main)
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
-if not BOT_TOKEN:
-    raise ValueError("No Telegram bot token found. Please set the TELEGRAM_BOT_TOKEN environment variable.")
+# Webhook mode: set WEBHOOK_URL to the public HTTPS address Telegram should post updates to
+# (it must end with WEBHOOK_PATH); without it the bot uses long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
 
 # List of owner usernames (replace with actual usernames)
 OWNER_USERNAMES = ['mada167', 'Nogitsuneiii', 'KanimaUC']  # Add all your owner usernames here
 
+# Keep owners and admin IDs in memory so authorization checks don't hit the database
+auth_cache = AuthCache(db, OWNER_USERNAMES)
+
+# Where the per-chat ledger (transactions and totals) lives: the main database, or with SHARDS > 1 that many
+# database files next to it, chosen by chat ID. Transaction entries are queued and committed in groups
+# (one queue per database); each handler waits for its own entry.
+SHARDS = int(os.getenv('SHARDS', 1))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL_MS', 5)) / 1000
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 256))
+if SHARDS > 1:
+    ledger_backend = sharding.ShardedBackend(db, sharding.shard_paths(DB_PATH, SHARDS), flush_interval=WRITE_FLUSH_INTERVAL, batch_size=WRITE_BATCH_SIZE)
+else:
+    ledger_backend = sharding.LedgerBackend(db, flush_interval=WRITE_FLUSH_INTERVAL, batch_size=WRITE_BATCH_SIZE)
+
+# Every chat the bot knows: registered users plus every chat with transactions, on any shard
+async def known_chats():
+    users = await db.fetchall("SELECT chat_id FROM users")
+    chats = await ledger_backend.fetchall_all("SELECT chat_id FROM chat_totals")
+    return [chat_id for (chat_id,) in users + chats]
+
+# Entries accepted from one multi-line message or uploaded file
+INGEST_MAX_ROWS = int(os.getenv('INGEST_MAX_ROWS', ingest.MAX_ROWS))
+
+# Chats per /summary page
+SUMMARY_PAGE_SIZE = int(os.getenv('SUMMARY_PAGE_SIZE', summary.PAGE_SIZE))
+
+# Rate-limited, resumable /sendmsg broadcasts
+broadcaster = BroadcastEngine(db, rate=float(os.getenv('BROADCAST_RATE', 25)), concurrency=int(os.getenv('BROADCAST_CONCURRENCY', 10)),
+                              recipients=known_chats)
+
+# /graph charts, rendered in worker processes and cached
+graph_renderer = graphs.GraphRenderer(ledger_backend, workers=int(os.getenv('GRAPH_WORKERS', 2)))
+
+# Retention: with RETENTION_DAYS set, transactions older than that many days are moved into compressed
+# monthly archive files every RETENTION_INTERVAL_HOURS; totals stay and /export still includes them
+archiver = retention.Archiver(ledger_backend, retention_days=int(os.getenv('RETENTION_DAYS', 0)),
+                              interval=float(os.getenv('RETENTION_INTERVAL_HOURS', 6)) * 3600,
+                              batch_size=int(os.getenv('RETENTION_BATCH_SIZE', retention.BATCH_SIZE)))
+
+# Time every database call and expose the queue depths
+for storage in {db, *ledger_backend.shards}:
+    storage.on_query = metrics.observe_query
+metrics.gauge('group_commit_queue_depth', ledger_backend.queue_depth, "Transaction entries waiting for the next group commit")
+metrics.gauge('broadcast_running_jobs', broadcaster.queue_depth, "Broadcast jobs currently sending")
+
+# Chat titles for the reports, cached with a TTL and looked up concurrently
+chat_meta = ChatMetaCache(db, ttl=int(os.getenv('CHAT_META_TTL', 12 * 3600)), concurrency=int(os.getenv('CHAT_META_CONCURRENCY', 8)),
+                          error_ttl=int(os.getenv('CHAT_META_ERROR_TTL', 600)))
+
+# Keep the names stored with the chat totals (for /summary sorted by name) in line with the name cache.
+# rows are (chat_id, stored name); only names that changed are written, on the chat's shard.
+async def store_chat_names(rows):
+    names = chat_meta.cached([chat_id for chat_id, _ in rows])
+    changes = {}
+    for chat_id, stored in rows:
+        if chat_id in names and names[chat_id] != stored:
+            changes.setdefault(ledger_backend.storage(chat_id), {})[chat_id] = names[chat_id]
+    await asyncio.gather(*(storage.transaction(summary.store_names, chat_names) for storage, chat_names in changes.items()))
+
+# Background lookups of chats that were listed by name before their name was known
+name_lookups = set()
+
+# Give chats without a stored name the cached name or, until it has been looked up, their ID, so the name
+# order of /summary is complete right away. Chats not in the cache are looked up once, in the background;
+# a failed lookup keeps the ID, so a dead chat isn't looked up again on every page.
+async def name_unnamed_chats(bot, chat_ids):
+    names = chat_meta.cached(chat_ids)
+    changes = {}
+    for chat_id in chat_ids:
+        changes.setdefault(ledger_backend.storage(chat_id), {})[chat_id] = names.get(chat_id, str(chat_id))
+    await asyncio.gather(*(storage.transaction(summary.store_names, chat_names) for storage, chat_names in changes.items()))
+
+    missing = [chat_id for chat_id in chat_ids if chat_id not in names]
+    if missing:
+        task = asyncio.create_task(look_up_chat_names(bot, missing))
+        name_lookups.add(task)
+        task.add_done_callback(name_lookups.discard)
+
+async def look_up_chat_names(bot, chat_ids):
+    try:
+        await chat_meta.names(bot, chat_ids)
+        await store_chat_names([(chat_id, str(chat_id)) for chat_id in chat_ids])
+    except Exception as e:
+        logging.error(f"Failed to look up chat names: {str(e)}")
+
+# Whether the handlers would act on an update's sender, from the in-memory cache only, for the admission control:
+# owners always; commands and buttons for admin chats; entries and files like may_add_transactions (admin chats
+# in private, admin users in groups). While the admin IDs are being reloaded everyone counts as authorized.
+def may_use_bot(update):
+    user = update.effective_user
+    chat = update.effective_chat
+    if user is None or chat is None or auth_cache.is_owner(user.username):
+        return True
+    message = update.effective_message
+    if update.callback_query is None and message is not None and (message.document is not None or (message.text or '')[:1] in ('+', '-')):
+        if chat.type in ['group', 'supergroup']:
+            return auth_cache.is_admin_cached(user.id) is not False
+        if chat.type != 'private':
+            return True
+    return auth_cache.is_admin_cached(chat.id) is not False
+
 # Function to check if the user is an owner (by username)
 def is_owner(update):
     user = update.message.from_user
-    return user.username in OWNER_USERNAMES  # Checks if the sender's username is in the list of owners
+    return auth_cache.is_owner(user.username)  # Checks if the sender's username is in the list of owners
 
 # Function to check if the user is an admin
-def is_admin(update):
+async def is_admin(update):
     chat_id = update.message.chat.id
-    c.execute("SELECT is_admin FROM users WHERE chat_id = ?", (chat_id,))
-    result = c.fetchone()
-    return result and result[0] == 1
+    return await auth_cache.is_admin(chat_id)
 
 # Add user to the users table, storing username and chat type
-def add_user(chat_id, username, is_admin=False, chat_type="private"):
-    c.execute("INSERT OR IGNORE INTO users (chat_id, username, is_admin, chat_type) VALUES (?, ?, ?, ?)", (chat_id, username, is_admin, chat_type))
-    conn.commit()
+async def add_user(chat_id, username, is_admin=False, chat_type="private"):
+    await db.execute("INSERT OR IGNORE INTO users (chat_id, username, is_admin, chat_type) VALUES (?, ?, ?, ?)", (chat_id, username, is_admin, chat_type))
 
-# Helper function to split large messages
+# Helper function to split large messages, at line breaks where possible so no line is cut in two
 def split_message(message, max_length=4096):
-    return [message[i:i + max_length] for i in range(0, len(message), max_length)]
+    chunks = []
+    while len(message) > max_length:
+        cut = message.rfind('\n', 0, max_length + 1)
+        if cut <= 0:
+            cut = max_length
+        chunks.append(message[:cut])
+        message = message[cut:].lstrip('\n')
+    if message or not chunks:
+        chunks.append(message)
+    return chunks
 
 # Command to add a new admin by username (only owner)
+@metrics.timed
 async def add_admin(update: Update, context):
     if not is_owner(update):
         return
@@ -94,13 +189,12 @@ async def add_admin(update: Update, context):
     username = context.args[0].lstrip('@')  # Remove "@" if the username has it
     
     # Check if the user exists in the database
-    c.execute("SELECT chat_id FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
+    result = await db.fetchone("SELECT chat_id FROM users WHERE username = ?", (username,))
 
     if result:
         # If user exists, update their admin status
-        c.execute("UPDATE users SET is_admin = 1 WHERE username = ?", (username,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_admin = 1 WHERE username = ?", (username,))
+        await auth_cache.invalidate()
         await update.message.reply_text(f"User with username @{username} has been added as an admin.")
     else:
         # If user doesn't exist, insert them into the database with is_admin = 1
@@ -109,6 +203,7 @@ async def add_admin(update: Update, context):
 
 
 # Command to remove an admin by username (only owner)
+@metrics.timed
 async def remove_admin(update: Update, context):
     if not is_owner(update):
         return
@@ -118,18 +213,18 @@ async def remove_admin(update: Update, context):
         return
 
     username = context.args[0].lstrip('@')
-    c.execute("UPDATE users SET is_admin = 0 WHERE username = ?", (username,))
-    conn.commit()
+    await db.execute("UPDATE users SET is_admin = 0 WHERE username = ?", (username,))
+    await auth_cache.invalidate()
 
     await update.message.reply_text(f"User with username @{username} has been removed from the admin list.")
 
 # Command to list all admins (only owner)
+@metrics.timed
 async def list_admins(update: Update, context):
     if not is_owner(update):
         return
 
-    c.execute("SELECT username FROM users WHERE is_admin = 1")
-    admins = c.fetchall()
+    admins = await db.fetchall("SELECT username FROM users WHERE is_admin = 1")
 
     if admins:
         admin_list = "\n".join([f"@{admin[0]}" for admin in admins])
@@ -140,6 +235,7 @@ async def list_admins(update: Update, context):
 
 
 # Start command handler with user tracking
+@metrics.timed
 async def start(update: Update, context):
     chat_id = update.message.chat.id
     user = update.message.from_user
@@ -147,7 +243,7 @@ async def start(update: Update, context):
     chat_type = update.message.chat.type
 
     # Add user to the database
-    add_user(chat_id, username, chat_type=chat_type)
+    await add_user(chat_id, username, chat_type=chat_type)
 
     # Greet the owner or regular users
     if is_owner(update):
@@ -155,58 +251,93 @@ async def start(update: Update, context):
     else:
         await update.message.reply_text("Welcome! You can interact with this bot.")
 
+# Check whether the sender may add transactions to this chat (owners anywhere, admins in their chats)
+async def may_add_transactions(update):
+    # Check if the user is an owner or an admin
+    if is_owner(update):
+        # Owners have full access in both private and group chats
+        return True
+
+    # Determine if the chat is private or a group
+    chat_type = update.message.chat.type
+    if chat_type == 'private':
+        if not await is_admin(update):
+            metrics.inc('updates_rejected_total')
+            return False  # Ignore messages from non-admins in private chat
+    elif chat_type in ['group', 'supergroup']:
+        # In a group, check admin status by the user's chat ID
+        if not await auth_cache.is_admin(update.message.from_user.id):  # If the user is not an admin
+            metrics.inc('updates_rejected_total')
+            return False  # Ignore messages from non-admins in group chats
+    return True
+
+# Add the parsed entries of a multi-line message or uploaded file in one transaction, and reply once
+# with the number added, the rejected lines and the new total
+async def import_batch(update, batch):
+    added = 0
+    if batch.entries:
+        # One executemany transaction on the chat's database instead of a group-committed write per entry
+        totals = await ledger_backend.storage(batch.chat_id).transaction(ledger.add_transactions, batch.entries)
+        added = len(totals)
+        metrics.inc('imported_transactions_total', value=added)
+        reply = f"Added {added} transaction(s)" + (f", {batch.rejected} line(s) rejected." if batch.rejected else ".") + f"\nTotal: {totals[-1]}"
+    else:
+        reply = "No transactions added."
+    if batch.rejected or batch.truncated or batch.lines_exceeded:
+        reply += "\n\n" + batch.error_report()
+
+    for chunk in split_message(reply):
+        await update.message.reply_text(chunk)
+
 # Handle regular messages with arithmetic operations
+@metrics.timed
 async def handle_message(update: Update, context):
     # Ensure that the update contains a message
     if update.message is None:
         return  # Ignore updates without messages (e.g., inline queries)
 
     chat_id = update.message.chat.id if update.message.chat else None
-    user = update.message.from_user
     text = update.message.text.strip()
 
     # If there's no chat in the update, return
     if chat_id is None:
         return  # Ignore messages with no valid chat
 
-    # Determine if the chat is private or a group
-    chat_type = update.message.chat.type
+    if not await may_add_transactions(update):
+        return
 
-    # Check if the user is an owner or an admin
-    if is_owner(update):
-        # Owners have full access in both private and group chats
-        pass
-    elif chat_type == 'private':
-        if not is_admin(update):
-            return  # Ignore messages from non-admins in private chat
-    elif chat_type in ['group', 'supergroup']:
-        # In a group, check admin status by the user's chat ID
-        c.execute("SELECT is_admin FROM users WHERE chat_id = ?", (user.id,))
-        result = c.fetchone()
-        if not result or result[0] != 1:  # If the user is not an admin
-            return  # Ignore messages from non-admins in group chats
+    # Several lines, each "+expression [category] [YYYY-MM-DD]": add them all at once
+    if '\n' in text and (text.startswith('+') or text.startswith('-')):
+        await import_batch(update, ingest.parse_lines(text, chat_id, ledger.today()))
+        return
+
+    # One line with a category or date: parsed like a line of a multi-line message, added like any single entry
+    if (text.startswith('+') or text.startswith('-')) and ingest.has_details(text):
+        batch = ingest.parse_lines(text, chat_id, ledger.today())
+        if batch.errors:
+            await update.message.reply_text(f"Invalid input: {batch.errors[0][1]}")
+            return
+        entry = batch.entries[0]
+        total = await ledger_backend.submit(entry)
+        await update.message.reply_text(f"Amount added: {entry[1]}\nTotal: {total}")
+        return
 
     # Check if the input starts with + or -
     if text.startswith('+') or text.startswith('-'):
         try:
             # Clean the text to allow only numbers and basic arithmetic operators
-            text = re.sub(r'[^0-9\.\+\-\*/\(\) ]', '', text)
+            text = expression.clean(text)
 
-            # Evaluate the arithmetic expression (e.g., +20*5 or -10/2)
-            amount = eval(text)
+            # Evaluate the arithmetic expression (e.g., +20*5 or -10/2) with the bounded, cached evaluator
+            amount = expression.evaluate(text)
 
             # Ensure the result is a valid number
             if isinstance(amount, (int, float)):
-                date = datetime.now().strftime("%Y-%m-%d")
+                day = ledger.today()
                 category = "general"  # Default category
 
-                # Insert the number along with the chat_id into the database
-                c.execute('INSERT INTO transactions (amount, date, category, chat_id) VALUES (?, ?, ?, ?)', (amount, date, category, chat_id))
-                conn.commit()
-
-                # Get the total amount for the specific chat
-                c.execute('SELECT SUM(amount) FROM transactions WHERE chat_id = ?', (chat_id,))
-                total = c.fetchone()[0]
+                # Insert the number along with the chat_id into the database and get the new total for the chat
+                total = await ledger_backend.submit((chat_id, amount, day, category))
 
                 await update.message.reply_text(f"Amount added: {amount}\nTotal: {total}")
             else:
@@ -217,133 +348,224 @@ async def handle_message(update: Update, context):
             await update.message.reply_text(f"An error occurred: {str(e)}")
 
 
+# Import an uploaded CSV file (as produced by /export, optionally gzip or zip compressed) into the chat (only owner or admin)
+@metrics.timed
+async def handle_document(update: Update, context):
+    # Edited messages and channel posts have no update.message
+    if update.message is None:
+        return
+
+    document = update.message.document
+    filename = document.file_name or ''
+    if not filename.lower().endswith(ingest.UPLOAD_SUFFIXES):
+        return  # Not a file to import
+    if not await may_add_transactions(update):
+        return
+
+    # Bots can only download files of up to 20 MB
+    if document.file_size and document.file_size > 20 * 1024 * 1024:
+        await update.message.reply_text("The file is too large to import (20 MB at most), split it into smaller files.")
+        return
+
+    chat_id = update.message.chat.id
+    try:
+        file = await document.get_file()
+        data = bytes(await file.download_as_bytearray())
+        # Decompressing and parsing a large file takes a while; keep it off the event loop
+        batch = await asyncio.to_thread(ingest.parse_upload, data, filename, chat_id, ledger.today(), INGEST_MAX_ROWS)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    await import_batch(update, batch)
+
 # Set custom report time (only owner)
+@metrics.timed
 async def set_report_time(update: Update, context):
     if not is_owner(update):
         return  # Ignore requests from non-owners
 
     user_id = update.message.chat.id
     if len(context.args) == 1:
+        time = context.args[0]
         try:
-            time = context.args[0]
             hour, minute = map(int, time.split(":"))
-            user_report_times[user_id] = (hour, minute)
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError(time)
+        except ValueError:
+            await update.message.reply_text("Invalid time format. Please use HH:MM.")
+            return
 
-            # Store the report time in the database
-            c.execute("REPLACE INTO report_times (chat_id, hour, minute) VALUES (?, ?, ?)", (user_id, hour, minute))
-            conn.commit()
+        # Store the report time in the database and reschedule the report right away
+        await report_scheduler.set_time(user_id, hour, minute)
 
-            await update.message.reply_text(f"Your report time is set to {time}.")
-        except:
-            await update.message.reply_text("Invalid time format. Please use HH:MM.")
+        await update.message.reply_text(f"Your report time is set to {time}.")
     else:
         await update.message.reply_text("Please provide the time in HH:MM format.")
 
-# Initialize a dictionary to store user report times
-user_report_times = {}
-
-# Load custom report times from the database at startup
-c.execute("SELECT chat_id, hour, minute FROM report_times")
-rows = c.fetchall()
-for row in rows:
-    user_report_times[row[0]] = (row[1], row[2])
+# Collect the data for the daily report: every chat's name, total and today's amount, computed once per time slot
+@metrics.timed
+async def build_report_snapshot(bot):
+    chats = await ledger_backend.fetchall_all("SELECT chat_id, total, name FROM chat_totals")
+    today = dict(await ledger_backend.fetchall_all("SELECT chat_id, sum FROM daily_totals WHERE day = ?", (ledger.today(),)))
+    chat_names = await chat_meta.names(bot, [chat_id for chat_id, _, _ in chats])
+    await store_chat_names([(chat_id, name) for chat_id, _, name in chats])
+    return [(chat_id, chat_names[chat_id], total, today.get(chat_id, 0)) for chat_id, total, _ in chats]
 
 # Send daily report with totals for all chats (only owner)
-async def send_daily_report(context):
-    user_ids = list(user_report_times.keys())
-
-    for user_id in user_ids:
-        chat_report = []
-        chats = c.execute("SELECT DISTINCT chat_id FROM transactions WHERE chat_id != ?", (user_id,)).fetchall()
-
-        for chat in chats:
-            chat_id = chat[0]
-            c.execute("SELECT SUM(amount) FROM transactions WHERE chat_id = ?", (chat_id,))
-            total = c.fetchone()[0]
-            if total is None:
-                total = 0
-
-            try:
-                chat_obj = await context.bot.get_chat(chat_id)
-                chat_name = chat_obj.title or chat_obj.username or str(chat_id)
-            except Exception as e:
-                chat_name = f"Chat ID: {chat_id} (error fetching details: {str(e)})"
-
-            chat_report.append(f"{chat_name} (ID: {chat_id}) - Total: {total}")
-
-        if chat_report:
-            report_message = "Daily Report of Transactions Across Chats:\n\n" + "\n.join(chat_report)"
-        else:
-            report_message = "No transactions found for today."
+@metrics.timed
+async def send_daily_report(bot, user_id, snapshot):
+    chat_report = [f"{chat_name} (ID: {chat_id}) - Total: {total} (today: {today})"
+                   for chat_id, chat_name, total, today in snapshot if chat_id != user_id]
+
+    if chat_report:
+        report_message = "Daily Report of Transactions Across Chats:\n\n" + "\n".join(chat_report)
+    else:
+        report_message = "No transactions found for today."
+
+    # Split and send large reports if necessary
+    for chunk in split_message(report_message):
+        await bot.send_message(chat_id=user_id, text=chunk)
 
-        # Split and send large reports if necessary
-        for chunk in split_message(report_message):
-            await context.bot.send_message(chat_id=user_id, text=chunk)
+# Daily reports: one job per subscriber, one snapshot per time slot
+report_scheduler = ReportScheduler(db, build_report_snapshot, send_daily_report)
 
 # Export transactions as CSV (only owner or admin)
+# Usage: /export [YYYY-MM-DD [YYYY-MM-DD]] [gzip|zip]
+@metrics.timed
 async def export_transactions(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+    if not is_owner(update) and not await is_admin(update):
         return  # Ignore requests from non-owners or non-admins
 
     user_id = update.message.chat.id
-    transactions = c.execute("SELECT * FROM transactions WHERE chat_id = ?", (user_id,)).fetchall()
-
-    file_path = os.path.join(os.getcwd(), f'transactions_{user_id}.csv')
-    # Write to a CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(["ID", "Amount", "Date", "Category", "Chat ID"])
-        writer.writerows(transactions)
-    
-    # Send the file to the user
     try:
-        await context.bot.send_document(chat_id=user_id, document=open(file_path, 'rb'))
+        start_day, end_day, compression = export.parse_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Usage: /export [YYYY-MM-DD [YYYY-MM-DD]] [gzip|zip]")
+        return
+
+    # Stream the rows into in-memory buffers and send each part as soon as it is complete
+    try:
+        async for filename, file in export.export_parts(ledger_backend.storage(user_id), user_id, start_day, end_day, compression):
+            # PTB reads uploads into memory anyway, and rejects spooled files because their name is None
+            with file:
+                await context.bot.send_document(chat_id=user_id, document=file.read(), filename=filename)
     except Exception as e:
+        metrics.inc('telegram_errors_total', (('method', 'send_document'),))
         logging.error(f"Failed to send document to {user_id}: {str(e)}")
 
 # Generate graphical report (only owner or admin)
+# Usage: /graph [daily|cumulative] [today|yesterday|week|month|year|30d|YYYY-MM-DD [YYYY-MM-DD]]
+@metrics.timed
 async def send_graph(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+    if not is_owner(update) and not await is_admin(update):
         return  # Ignore requests from non-owners or non-admins
 
     user_id = update.message.chat.id
-    transactions = c.execute("SELECT date, SUM(amount) FROM transactions WHERE chat_id = ? GROUP BY date", (user_id,)).fetchall()
-
-    dates = [row[0] for row in transactions]
-    totals = [row[1] for row in transactions]
+    try:
+        variant, start_day, end_day = graphs.parse_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Usage: /graph [daily|cumulative] [today|yesterday|week|month|year|30d|YYYY-MM-DD [YYYY-MM-DD]]")
+        return
 
-    plt.plot(dates, totals)
-    plt.title('Transaction History')
-    plt.xlabel('Date')
-    plt.ylabel('Total Amount')
+    # The last transaction ID identifies the chat's current data, so unchanged charts come from the cache
+    row = await ledger_backend.storage(user_id).fetchone("SELECT last_id FROM chat_totals WHERE chat_id = ?", (user_id,))
+    last_id = row[0] if row else None
 
-    plt.savefig('transaction_graph.png')
     try:
-        await context.bot.send_photo(chat_id=user_id, photo=open('transaction_graph.png', 'rb'))
+        png = await graph_renderer.render(user_id, last_id, variant, start_day, end_day)
+        if png is None:
+            await update.message.reply_text("No transactions to plot.")
+            return
+        await context.bot.send_photo(chat_id=user_id, photo=png)
     except Exception as e:
+        metrics.inc('telegram_errors_total', (('method', 'send_photo'),))
         logging.error(f"Failed to send graph to {user_id}: {str(e)}")
 
+# Total of the chat's transactions over a range (only owner or admin)
+# Usage: /total [today|yesterday|week|month|year|30d|YYYY-MM-DD [YYYY-MM-DD]]
+@metrics.timed
+async def show_total(update: Update, context):
+    if not is_owner(update) and not await is_admin(update):
+        return  # Ignore requests from non-owners or non-admins
+
+    user_id = update.message.chat.id
+    try:
+        start_day, end_day, label = ledger.parse_range(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Usage: /total [today|yesterday|week|month|year|30d|YYYY-MM-DD [YYYY-MM-DD]]")
+        return
+
+    # Read from the per-day rollup: one row per day in the range, however many entries it holds
+    amount, count = await ledger_backend.storage(user_id).read(ledger.range_total, user_id, start_day, end_day)
+    await update.message.reply_text(f"Total for {label}: {amount} ({count} transaction(s))")
+
 # Reset user transactions (only owner or admin)
+@metrics.timed
 async def reset_transactions(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+    if not is_owner(update) and not await is_admin(update):
         return  # Ignore requests from non-owners or non-admins
 
     user_id = update.message.chat.id
-    c.execute('DELETE FROM transactions WHERE chat_id = ?', (user_id,))
-    conn.commit()
+    await ledger_backend.storage(user_id).transaction(ledger.reset_chat, user_id)
     await update.message.reply_text("All your transactions have been reset.")
 
 # Delete summary of all transactions (only owner)
+@metrics.timed
 async def delete_summary(update: Update, context):
     if not is_owner(update):
         return  # Ignore requests from non-owners
 
-    # Delete all transaction data for all chats
-    c.execute('DELETE FROM transactions')
-    conn.commit()
+    # Delete all transaction data for all chats, on every shard
+    await ledger_backend.transaction_all(ledger.delete_all)
     await update.message.reply_text("Summary of all chats has been deleted.")
 
+# Check the maintained per-chat totals against the transactions table (only owner)
+@metrics.timed
+async def verify_totals(update: Update, context):
+    if not is_owner(update):
+        return  # Ignore requests from non-owners
+
+    mismatches = [mismatch for shard in await ledger_backend.read_all(ledger.verify_totals) for mismatch in shard]
+    if mismatches:
+        lines = [f"Chat ID {chat_id}: stored {stored}, actual {actual}" for chat_id, stored, actual in mismatches]
+        report = f"{len(mismatches)} chat total(s) are out of sync. Use /rebuildtotals to fix them.\n\n" + "\n".join(lines)
+    else:
+        report = "All chat totals are in sync."
+
+    for chunk in split_message(report):
+        await update.message.reply_text(chunk)
+
+# Recompute the per-chat and per-day totals from the transactions table, in one transaction
+def rebuild_all_totals(conn):
+    return ledger.rebuild_totals(conn), ledger.rebuild_daily_totals(conn)
+
+# Recompute the per-chat and per-day totals from the transactions table (only owner)
+@metrics.timed
+async def rebuild_totals(update: Update, context):
+    if not is_owner(update):
+        return  # Ignore requests from non-owners
+
+    results = await ledger_backend.transaction_all(rebuild_all_totals)
+    chats, days = sum(result[0] for result in results), sum(result[1] for result in results)
+    await update.message.reply_text(f"Totals rebuilt for {chats} chat(s) and {days} chat day(s).")
+
+# Move old transactions into the archive files now (only owner)
+# Usage: /archive [DAYS] - archive everything older than DAYS days (default: RETENTION_DAYS)
+@metrics.timed
+async def archive_transactions(update: Update, context):
+    if not is_owner(update):
+        return  # Ignore requests from non-owners
+
+    days = context.args[0] if context.args else archiver.retention_days
+    if not str(days).isdigit() or int(days) < 1:
+        await update.message.reply_text("Usage: /archive DAYS (or set RETENTION_DAYS)")
+        return
+
+    archived, freed = await archiver.run(int(days))
+    await update.message.reply_text(f"Archived {archived} transaction(s) older than {days} day(s), freed {freed} database page(s).")
+
 # Command to remove a specific user (only owner)
+@metrics.timed
 async def remove_user(update: Update, context):
     if not is_owner(update):
         await update.message.reply_text("You are not authorized to use this command.")
@@ -359,16 +581,17 @@ async def remove_user(update: Update, context):
     if identifier.isdigit():
         # Remove by chat ID
         chat_id = int(identifier)
-        c.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+        await db.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
     else:
         # Remove by username
         username = identifier.lstrip('@')  # Remove @ if provided
-        c.execute("DELETE FROM users WHERE username = ?", (username,))
+        await db.execute("DELETE FROM users WHERE username = ?", (username,))
 
-    conn.commit()
+    await auth_cache.invalidate()
     await update.message.reply_text(f"User {identifier} has been removed.")
 
 # Command to remove all users (only owner)
+@metrics.timed
 async def remove_all_users(update: Update, context):
     if not is_owner(update):
         await update.message.reply_text("You are not authorized to use this command.")
@@ -377,8 +600,8 @@ async def remove_all_users(update: Update, context):
     # Confirmation check
     if len(context.args) == 1 and context.args[0].lower() == 'confirm':
         # Remove all users from the users table
-        c.execute("DELETE FROM users")
-        conn.commit()
+        await db.execute("DELETE FROM users")
+        await auth_cache.invalidate()
         await update.message.reply_text("All users have been removed.")
     else:
         # Ask for confirmation
@@ -387,28 +610,17 @@ async def remove_all_users(update: Update, context):
 
 
 # Send message to all users (admin and owner)
+@metrics.timed
 async def sendmsg(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+    if not is_owner(update) and not await is_admin(update):
         await update.message.reply_text("You are not authorized to use this command.")
         return
     
     if context.args:
         message = " ".join(context.args).replace('\\n', '\n')
-        MAX_MESSAGE_LENGTH = 4096
-        # Fetch all unique chat IDs from users and transactions
+        # Queue the broadcast; the engine paces the sends and keeps the admin posted through one progress message
         try:
-            c.execute("SELECT DISTINCT chat_id FROM users UNION SELECT DISTINCT chat_id FROM transactions")
-            all_chat_ids = c.fetchall()
-            message_chunks = [message[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(message), MAX_MESSAGE_LENGTH)]
-
-            for chat_id_tuple in all_chat_ids:
-                chat_id = chat_id_tuple[0]
-                for chunk in message_chunks:
-                    try:
-                        await context.bot.send_message(chat_id=chat_id, text=chunk, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        logging.error(f"Failed to send message to {chat_id}: {str(e)}")
-                        await update.message.reply_text(f"Failed to send message to chat ID {chat_id}.")
+            await broadcaster.start(context.bot, update.message.chat.id, message)
         except Exception as e:
             await update.message.reply_text("Failed to fetch chat IDs or send messages.")
             logging.error(f"Error in sending messages: {e}")
@@ -416,22 +628,17 @@ async def sendmsg(update: Update, context):
         await update.message.reply_text("Please provide a message to send.")
 
 # Show the owner who is using the bot (only owner)
+@metrics.timed
 async def show_users(update: Update, context):
     if not is_owner(update):
         return  # Ignore requests from non-owners
 
     # Fetch all users from the database
-    users = c.execute("SELECT chat_id, username FROM users").fetchall()
+    users = await db.fetchall("SELECT chat_id, username FROM users")
 
     user_list = []
     for user in users:
         chat_id, username = user
-        try:
-            chat = await context.bot.get_chat(chat_id)
-            chat_name = chat.title or chat.username or str(chat_id)
-        except Exception as e:
-            chat_name = f"Chat ID: {chat_id} (error fetching details: {str(e)})"
-        
         user_list.append(f"@{username} (Chat ID: {chat_id})")
 
     if user_list:
@@ -441,73 +648,271 @@ async def show_users(update: Update, context):
 
     await update.message.reply_text(user_report)
 
+# Show hit/miss counters of the in-memory caches (only owner)
+@metrics.timed
+async def cache_stats(update: Update, context):
+    if not is_owner(update):
+        return  # Ignore requests from non-owners
+
+    sections = []
+    for title, stats in (("Authorization cache", auth_cache.stats()), ("Chat name cache", chat_meta.stats()), ("Graph cache", graph_renderer.stats())):
+        lines = [f"{name}: {value}" for name, value in stats.items()]
+        sections.append(f"{title}:\n" + "\n".join(lines))
+    await update.message.reply_text("\n\n".join(sections))
+
+# Show handler latencies, query timings, counters and queue depths, and the state of the background work (only owner)
+@metrics.timed
+async def stats(update: Update, context):
+    if not is_owner(update):
+        return  # Ignore requests from non-owners
+
+    sections = [metrics.render_text()]
+    for title, values in (("Broadcasts", broadcaster.stats()), ("Daily reports", report_scheduler.stats()),
+                          ("Archive", archiver.stats())):
+        lines = [f"{name}: {value}" for name, value in values.items()]
+        sections.append(f"{title}:\n" + "\n".join(lines))
+    for chunk in split_message("\n\n".join(sections)):
+        await update.message.reply_text(chunk)
+
+# Count every incoming update (runs before the other handlers)
+async def count_update(update: Update, context):
+    metrics.inc('updates_total')
+
+# Log and count errors raised by handlers
+async def on_error(update, context):
+    metrics.inc('errors_total')
+    logging.error(f"Error while handling an update: {context.error}")
+
 # Help command (admin and owner)
+@metrics.timed
 async def helpme(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+    if not is_owner(update) and not await is_admin(update):
         return  # Ignore requests from non-owners or non-admins
 
     help_text = (
         "/start - Start the bot\n"
         "/setreporttime HH:MM - Set daily report time\n"
-        "/export - Export your transactions as a CSV file\n"
-        "/graph - Get a graphical report of your transactions\n"
+        "/export [from] [to] [gzip|zip] - Export your transactions as a CSV file\n"
+        "/graph [daily|cumulative] [range] - Get a graphical report of your transactions\n"
+        "/total [today|week|month|year|30d|from to] - Total of your transactions over a range\n"
         "/reset - Reset all your transactions\n"
+        "Several +/- lines in one message, or a CSV file in /export's format, add all entries at once\n"
         "/sendmsg [message] - Send a message to all users (admin only)\n"
         "/removeuser @username - removeuser username/chat_id\n"
         "/removeallusers - removeallusers confirm\n"
-        "/summary - Get a summary of all transactions across all chats\n"
+        "/summary [total|name|recent] - Browse the totals of all chats, one page at a time\n"
         "/addadmin @username - Add a new admin (owner only)\n"
         "/removeadmin @username - Remove an admin (owner only)\n"
         "/listadmins - List all current admins (owner only)\n"
         "/deletesummary - Delete summary of all transactions (owner only)\n"
+        "/verifytotals - Check the stored chat totals against all transactions (owner only)\n"
+        "/rebuildtotals - Recompute the stored chat and daily totals (owner only)\n"
+        "/archive [days] - Move old transactions into the archive files (owner only)\n"
         "/showusers - Show all users using the bot (owner only)\n"
+        "/cachestats - Show cache hit/miss counters (owner only)\n"
+        "/stats - Show latency, query and error statistics (owner only)\n"
         "/helpme - Display this help message"
     )
     await update.message.reply_text(help_text)
 
-# Summary of all transactions across all chats (admin and owner)
-async def summary(update: Update, context):
-    if not is_owner(update) and not is_admin(update):
+# Text and keyboard of one /summary page; only the chats of that page are read and named
+async def render_summary_page(bot, sort, page, anchor=None, backward=False):
+    if sort == 'n':
+        unnamed = await summary.unnamed_chats(ledger_backend)
+        if unnamed:
+            await name_unnamed_chats(bot, unnamed)
+    rows, more = await summary.fetch_page(ledger_backend, sort, anchor, backward, SUMMARY_PAGE_SIZE)
+    if backward and len(rows) < SUMMARY_PAGE_SIZE:
+        # Chats were removed since the later page was shown: start again from the first page
+        page, backward = 1, False
+        rows, more = await summary.fetch_page(ledger_backend, sort, page_size=SUMMARY_PAGE_SIZE)
+    if not rows:
+        return "No transactions found across all chats.", None
+
+    chat_names = await chat_meta.names(bot, [chat_id for chat_id, _, _, _ in rows])
+    await store_chat_names([(chat_id, name) for chat_id, _, name, _ in rows])
+    if sort == 'n':
+        # Show the names the page is sorted by (a refreshed name takes its place from the next page on)
+        chat_names.update({chat_id: name for chat_id, _, name, _ in rows if name})
+    has_next = more if not backward else True
+    text = summary.format_page(rows, chat_names, sort, page, SUMMARY_PAGE_SIZE)
+    return text, summary.keyboard(rows, sort, page, page > 1, has_next)
+
+# Summary of all transactions across all chats, one page at a time (admin and owner)
+# Usage: /summary [total|name|recent]
+@metrics.timed
+async def summary_command(update: Update, context):
+    if not is_owner(update) and not await is_admin(update):
         return  # Ignore requests from non-owners or non-admins
 
-    admin_chat_id = update.message.chat.id
-    summary_report = []
-    chats = c.execute("SELECT DISTINCT chat_id FROM transactions").fetchall()
-
-    for chat in chats:
-        chat_id = chat[0]
-        c.execute("SELECT SUM(amount) FROM transactions WHERE chat_id = ?", (chat_id,))
-        total = c.fetchone()[0]
-        if total is None:
-            total = 0
-
-        try:
-            chat_obj = await context.bot.get_chat(chat_id)
-            chat_name = chat_obj.title or chat_obj.username or str(chat_id)
-        except Exception as e:
-            chat_name = f"Chat ID: {chat_id} (error fetching details: {str(e)})"
-
-        summary_report.append(f"{chat_name} (ID: {chat_id}) - Total: {total}")
+    sorts = {'total': 't', 'name': 'n', 'recent': 'r'}
+    sort = sorts.get(context.args[0].lower(), 't') if context.args else 't'
+    text, keyboard = await render_summary_page(context.bot, sort, 1)
+    await context.bot.send_message(chat_id=update.message.chat.id, text=text, reply_markup=keyboard)
+
+# Prev/next and sort buttons of a /summary page: the message is edited in place with the requested page
+@metrics.timed
+async def summary_page(update: Update, context):
+    query = update.callback_query
+    if not auth_cache.is_owner(query.from_user.username) and not await auth_cache.is_admin(query.message.chat.id):
+        await query.answer()
+        return  # Ignore requests from non-owners or non-admins
 
-    if summary_report:
-        summary_message = "Summary of Transactions Across All Chats:\n\n" + "\n".join(summary_report)
-    else:
-        summary_message = "No transactions found across all chats."
+    try:
+        sort, page, chat_id, key, backward = summary.parse_callback(query.data)
+    except ValueError:
+        await query.answer("This button is no longer valid, send /summary again.")
+        return
 
-    # Split and send the summary report in case it's too long
-    for chunk in split_message(summary_message):
-        await context.bot.send_message(chat_id=admin_chat_id, text=chunk)
+    anchor = None
+    if chat_id is not None:
+        if key is None:
+            # The anchor's name didn't fit into the button; its stored name is the position to continue from
+            row = await ledger_backend.storage(chat_id).fetchone("SELECT name FROM chat_totals WHERE chat_id = ?", (chat_id,))
+            key = row[0] if row else None
+        if key is None:
+            page, backward = 1, False
+        else:
+            anchor = (key, chat_id)
 
-# Graceful shutdown to ensure proper cleanup
-async def shutdown(application):
-    await application.shutdown()
-    scheduler.shutdown(wait=False)
-    conn.close()
+    text, keyboard = await render_summary_page(context.bot, sort, page, anchor, backward)
+    await query.answer()
+    try:
+        await query.edit_message_text(text=text, reply_markup=keyboard)
+    except BadRequest as e:
+        # Tapping the sort order that is already shown doesn't change the message
+        if 'not modified' not in str(e):
+            raise
+
+# Stop the background work started in post_init; safe to call more than once
+async def stop_background_work():
+    # Interrupted broadcasts keep their pending recipients and continue on the next start
+    await broadcaster.stop()
+    await archiver.stop()
+    report_scheduler.shutdown()
+    lookups = list(name_lookups)
+    for task in lookups:
+        task.cancel()
+    await asyncio.gather(*lookups, return_exceptions=True)
+
+# Run by the application after it stopped taking updates and the running handlers finished, while the bot's
+# HTTP client is still open: broadcasts and reports stop before their sends could fail and mark chats as failed
+async def post_stop(application):
+    await stop_background_work()
+
+# Graceful shutdown, run after the bot's HTTP client is closed: commit the queued entries and close the database.
+# The background work is normally stopped in post_stop already; it isn't called if the application never started.
+async def post_shutdown(application):
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+    await stop_background_work()
+    graph_renderer.shutdown()
+    await ledger_backend.close()
+    db.close()
+
+# Runs inside the application's event loop once the bot is initialized
+async def post_init(application):
+    # Continue broadcasts that were interrupted by a restart
+    await broadcaster.resume(application.bot)
+
+    # Schedule daily reports based on user-set times (for the owner or admins)
+    report_scheduler.start(application.bot)
+
+    # Move transactions past the retention period into the archive, in the background
+    archiver.start()
+
+    # Optional local Prometheus endpoint
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        application.bot_data['metrics_server'] = await metrics.start_http_server(os.getenv('METRICS_HOST', '127.0.0.1'), int(metrics_port))
+
+# Bring the database schema up to date and load the state kept in memory
+def init_database():
+    migrations.migrate(db)
+    ledger_backend.migrate()
+
+    auth_cache.load_sync()
+    chat_meta.load_sync()
+    # Names of chats resolved since the last start, for /summary sorted by name
+    ledger_backend.run_sync_all(summary.store_names, chat_meta.cached())
+
+    # Load custom report times from the database at startup
+    report_scheduler.load_sync()
+
+# Offline schema maintenance: --check reports pending migrations, --migrate applies them,
+# --rebuild-totals recomputes (or backfills) chat_totals and daily_totals,
+# --rebalance-shards N moves the ledger into N shard files (1: back into the main database),
+# --vacuum switches the database files to incremental auto-vacuum
+def run_schema_command(args):
+    if args.rebalance_shards is not None:
+        chats, transactions = sharding.rebalance(DB_PATH, args.rebalance_shards)
+        print(f"Moved {transactions} transaction(s) of {chats} chat(s) into {args.rebalance_shards} shard(s). "
+              f"Start the bot with SHARDS={args.rebalance_shards}.")
+        return 0
+
+    if args.vacuum:
+        for path in [DB_PATH] + sharding.existing_shard_paths(DB_PATH):
+            changed = retention.enable_incremental_vacuum(path)
+            print(f"{path}: {'switched to' if changed else 'already uses'} incremental auto-vacuum.")
+        return 0
+
+    if args.rebuild_totals:
+        init_database()
+        results = ledger_backend.run_sync_all(rebuild_all_totals)
+        print(f"Totals rebuilt for {sum(r[0] for r in results)} chat(s) and {sum(r[1] for r in results)} chat day(s).")
+        return 0
+
+    # Shards that don't exist yet are created (and migrated) when the bot starts
+    storages = [db] + [shard for shard in ledger_backend.shards if shard is not db and os.path.exists(shard.path)]
+    if args.check:
+        pending = False
+        for storage in storages:
+            print(f"{storage.path}: schema version {storage.run_sync(migrations.current_version)}")
+            for version, description in storage.run_sync(migrations.pending):
+                print(f"Pending migration {version}: {description}")
+                pending = True
+        return 1 if pending else 0
+
+    for storage in storages:
+        applied = migrations.migrate(storage)
+        print(f"{storage.path}: applied {len(applied)} migration(s), schema version is now {storage.run_sync(migrations.current_version)}.")
+    return 0
+
+# Build the Application with every handler registered; nothing is sent to Telegram until it runs.
+# PTB's application module (with its web server) and the update processor are imported here, so
+# tools and the schema commands that import this module don't pay for them.
+def create_application(token):
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters
+    from admission import AdmissionControl
+    from dispatch import HEAVY_COMMANDS, ChatUpdateProcessor
+
+    # Flood protection: per-user and per-chat rates, stricter limits for the expensive commands (owners are exempt
+    # from those), and repeated /summary or /graph requests are merged while the first one runs
+    admission = AdmissionControl(user_rate=float(os.getenv('USER_RATE', 1)), user_burst=int(os.getenv('USER_BURST', 10)),
+                                 chat_rate=float(os.getenv('CHAT_RATE', 5)), chat_burst=int(os.getenv('CHAT_BURST', 30)),
+                                 expensive_commands=HEAVY_COMMANDS,
+                                 expensive_per_minute=float(os.getenv('EXPENSIVE_PER_MINUTE', 6)),
+                                 expensive_burst=int(os.getenv('EXPENSIVE_BURST', 3)),
+                                 cooldown=float(os.getenv('COMMAND_COOLDOWN', 3)), exempt_usernames=OWNER_USERNAMES,
+                                 authorized=may_use_bot)
+
+    # Updates of different chats are handled concurrently, each chat's updates in order
+    update_processor = ChatUpdateProcessor(concurrency=int(os.getenv('UPDATE_CONCURRENCY', 64)),
+                                           heavy_concurrency=int(os.getenv('HEAVY_UPDATE_CONCURRENCY', 4)),
+                                           max_pending=int(os.getenv('MAX_PENDING_UPDATES', 512)),
+                                           max_chat_pending=int(os.getenv('MAX_PENDING_UPDATES_PER_CHAT', 32)), admission=admission)
 
-# Main function to start the bot
-def main():
     # Create the application with the secure token
-    application = Application.builder().token(BOT_TOKEN).build()
+    # job_queue(None): daily reports have their own scheduler, PTB doesn't need to start a second one
+    application = (Application.builder().token(token).concurrent_updates(update_processor).job_queue(None)
+                   .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build())
+
+    # Count every update before it reaches the handlers, and count handler errors
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
+    application.add_error_handler(on_error)
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))  # /start
@@ -516,33 +921,94 @@ def main():
     application.add_handler(CommandHandler("removeuser", remove_user))  # /removeuser username/chat_id
     application.add_handler(CommandHandler("removeallusers", remove_all_users))  # /removeallusers confirm
     application.add_handler(CommandHandler("helpme", helpme))  # /helpme
-    application.add_handler(CommandHandler("summary", summary))  # /summary
+    application.add_handler(CommandHandler("summary", summary_command))  # /summary
+    application.add_handler(CallbackQueryHandler(summary_page, pattern=f"^{summary.CALLBACK_PREFIX}:"))  # /summary buttons
     application.add_handler(CommandHandler("export", export_transactions))  # /export
     application.add_handler(CommandHandler("graph", send_graph))  # /graph
+    application.add_handler(CommandHandler("total", show_total))  # /total
     application.add_handler(CommandHandler("reset", reset_transactions))  # /reset
     application.add_handler(CommandHandler("addadmin", add_admin))  # /addadmin
     application.add_handler(CommandHandler("removeadmin", remove_admin))  # /removeadmin
     application.add_handler(CommandHandler("listadmins", list_admins))  # /listadmins
     application.add_handler(CommandHandler("deletesummary", delete_summary))  # /deletesummary
+    application.add_handler(CommandHandler("verifytotals", verify_totals))  # /verifytotals
+    application.add_handler(CommandHandler("rebuildtotals", rebuild_totals))  # /rebuildtotals
+    application.add_handler(CommandHandler("archive", archive_transactions))  # /archive
     application.add_handler(CommandHandler("showusers", show_users))  # /showusers
+    application.add_handler(CommandHandler("cachestats", cache_stats))  # /cachestats
+    application.add_handler(CommandHandler("stats", stats))  # /stats
 
     # Add a message handler for regular messages (only owner or admin)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    # Schedule daily report to be sent at custom times (for the owner or admins)
-    scheduler = AsyncIOScheduler()
+    # Uploaded CSV files are imported as transactions (only owner or admin)
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
-    # Schedule daily reports based on user-set times
-    for user_id, (hour, minute) in user_report_times.items():
-        scheduler.add_job(send_daily_report, 'cron', hour=hour, minute=minute, args=[application])
+    return application
 
-    scheduler.start()
+# Print how long each startup phase takes and the peak memory, without connecting to Telegram
+def measure_startup(imported):
+    phases = [("imports", imported - STARTED)]
 
-    # Graceful shutdown handling (useful for production)
-    try:
+    started = time.perf_counter()
+    init_database()
+    phases.append(("database (migrations and caches)", time.perf_counter() - started))
+
+    started = time.perf_counter()
+    create_application(BOT_TOKEN or '0:startup-time')
+    phases.append(("application and handlers", time.perf_counter() - started))
+
+    for name, seconds in phases:
+        print(f"{name}: {seconds * 1000:.1f} ms")
+    print(f"total: {(time.perf_counter() - STARTED) * 1000:.1f} ms")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"matplotlib loaded: {'yes' if 'matplotlib' in sys.modules else 'no'}")
+    return 0
+
+# Main function to start the bot
+def main():
+    imported = time.perf_counter()
+    parser = argparse.ArgumentParser(description="Transactions Telegram bot")
+    parser.add_argument('--migrate', action='store_true', help="apply pending database migrations and exit")
+    parser.add_argument('--check', action='store_true', help="list pending database migrations and exit (exit code 1 if any)")
+    parser.add_argument('--rebuild-totals', action='store_true', help="recompute the chat and daily totals from all transactions and exit")
+    parser.add_argument('--rebalance-shards', type=int, metavar='N', help="move the ledger into N shard files (1: into the main database) and exit; stop the bot first")
+    parser.add_argument('--vacuum', action='store_true', help="switch the database files to incremental auto-vacuum (rewrites them) and exit; stop the bot first")
+    parser.add_argument('--startup-time', action='store_true', help="measure the startup phases and exit without connecting to Telegram")
+    args = parser.parse_args()
+
+    # Setup logging for better debugging and monitoring
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.startup_time:
+        try:
+            sys.exit(measure_startup(imported))
+        finally:
+            db.close()
+
+    if args.migrate or args.check or args.rebuild_totals or args.vacuum or args.rebalance_shards is not None:
+        try:
+            sys.exit(run_schema_command(args))
+        finally:
+            db.close()
+
+    if not BOT_TOKEN:
+        raise ValueError("No Telegram bot token found. Please set the TELEGRAM_BOT_TOKEN environment variable.")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise ValueError("Webhook mode needs a secret. Please set the WEBHOOK_SECRET environment variable.")
+
+    init_database()
+    application = create_application(BOT_TOKEN)
+
+    # Both modes stop on SIGINT/SIGTERM, wait for the running handlers and then call post_stop and post_shutdown
+    if WEBHOOK_URL:
+        # Telegram posts updates to WEBHOOK_URL; requests without the matching
+        # X-Telegram-Bot-Api-Secret-Token header are rejected with 403
+        application.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    else:
         application.run_polling()
-    except KeyboardInterrupt:
-        shutdown(application)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter
+
+import metrics
+from ratelimit import TokenBucket
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+# Sends one message to every chat the bot knows.
+# - a global token bucket keeps the bot under Telegram's overall flood limit,
+#   and each chat gets at most one message per `per_chat_interval` seconds
+# - at most `concurrency` sends are in flight at a time
+# - RetryAfter answers pause the whole bucket for the requested time and the send is retried
+# - jobs and per-recipient progress are stored in broadcast_jobs / broadcast_recipients,
+#   so a broadcast interrupted by a restart continues with the chats that are still pending
+# - the requesting admin gets one progress message that is edited as the job advances,
+#   and a final summary instead of one reply per failure
+class BroadcastEngine:
+    def __init__(self, db, rate=25, concurrency=10, per_chat_interval=1.0, max_retries=5, progress_interval=3.0, flush_size=50, recipients=None):
+        self.db = db
+        # async function returning the chat IDs to send to (by default every chat the database knows)
+        self.recipients = recipients or self._known_chats
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.flush_size = flush_size
+        self._tasks = {}
+        self.retries = 0
+
+    async def _known_chats(self):
+        return [chat_id for (chat_id,) in await self.db.fetchall("SELECT chat_id FROM users UNION SELECT chat_id FROM chat_totals")]
+
+    # Create a job for every known chat and start sending, returns the job ID
+    async def start(self, bot, requested_by, message):
+        chat_ids = set(await self.recipients())
+
+        def create(conn):
+            cursor = conn.execute("INSERT INTO broadcast_jobs (message, requested_by, status, created_at) VALUES (?, ?, 'running', ?)",
+                                  (message, requested_by, int(time.time())))
+            job_id = cursor.lastrowid
+            conn.executemany("INSERT INTO broadcast_recipients (job_id, chat_id, status) VALUES (?, ?, 'pending')",
+                             [(job_id, chat_id) for chat_id in chat_ids if chat_id is not None])
+            return job_id
+
+        job_id = await self.db.transaction(create)
+        total = len(chat_ids - {None})
+        try:
+            progress = await bot.send_message(chat_id=requested_by, text=f"Broadcast #{job_id}: sending to {total} chat(s)...")
+            await self.db.execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?", (progress.message_id, job_id))
+        except Exception as e:
+            logging.error(f"Failed to send broadcast progress message to {requested_by}: {str(e)}")
+        self._launch(bot, job_id)
+        return job_id
+
+    # Continue every job that was still running when the bot stopped
+    async def resume(self, bot):
+        jobs = await self.db.fetchall("SELECT id FROM broadcast_jobs WHERE status = 'running'")
+        for (job_id,) in jobs:
+            if job_id not in self._tasks:
+                logging.info(f"Resuming broadcast #{job_id}")
+                self._launch(bot, job_id)
+        return [job_id for (job_id,) in jobs]
+
+    # Wait for running jobs to finish (mainly for tools and tests)
+    async def wait(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    # Stop running jobs; their pending recipients stay in the database for resume()
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    def queue_depth(self):
+        return len(self._tasks)
+
+    def _launch(self, bot, job_id):
+        task = asyncio.create_task(self._run(bot, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _send(self, bot, chat_id, chunks):
+        for index, chunk in enumerate(chunks):
+            if index:
+                await asyncio.sleep(self.per_chat_interval)
+            attempt = 0
+            while True:
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=chunk, parse_mode=ParseMode.MARKDOWN)
+                    break
+                except RetryAfter as e:
+                    attempt += 1
+                    self.retries += 1
+                    metrics.inc('telegram_retries_total', (('method', 'send_message'),))
+                    if attempt > self.max_retries:
+                        raise
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                    self.bucket.pause(retry_after)
+
+    async def _run(self, bot, job_id):
+        job = await self.db.fetchone("SELECT message, requested_by, progress_message_id FROM broadcast_jobs WHERE id = ?", (job_id,))
+        message, requested_by, progress_message_id = job
+        chunks = [message[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(message), MAX_MESSAGE_LENGTH)]
+        pending = await self.db.fetchall("SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending'", (job_id,))
+
+        queue = asyncio.Queue()
+        for (chat_id,) in pending:
+            queue.put_nowait(chat_id)
+        results = []
+
+        async def flush():
+            if results:
+                batch = results[:]
+                results.clear()
+                await self.db.executemany("UPDATE broadcast_recipients SET status = ?, error = ? WHERE job_id = ? AND chat_id = ?",
+                                          [(status, error, job_id, chat_id) for chat_id, status, error in batch])
+
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._send(bot, chat_id, chunks)
+                    results.append((chat_id, 'sent', None))
+                except Exception as e:
+                    metrics.inc('telegram_errors_total', (('method', 'send_message'),))
+                    logging.error(f"Failed to send message to {chat_id}: {str(e)}")
+                    results.append((chat_id, 'failed', str(e)))
+                if len(results) >= self.flush_size:
+                    await flush()
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                await flush()
+                await self._edit_progress(bot, job_id, requested_by, progress_message_id, await self._counts(job_id))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(pending)))]
+        progress_task = asyncio.create_task(report_progress())
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            progress_task.cancel()
+            for task in workers:
+                task.cancel()
+            # Record what was delivered even when interrupted, so resume() doesn't send it twice
+            await flush()
+
+        await self.db.execute("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?", (int(time.time()), job_id))
+        counts = await self._counts(job_id)
+        failed = await self.db.fetchall("SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = 'failed' LIMIT 20", (job_id,))
+        text = f"Broadcast #{job_id} finished: sent to {counts['sent']} chat(s), failed for {counts['failed']}."
+        if failed:
+            text += "\nFailed chat IDs: " + ", ".join(str(chat_id) for (chat_id,) in failed)
+            if counts['failed'] > len(failed):
+                text += ", ..."
+        await self._edit_progress(bot, job_id, requested_by, progress_message_id, counts, text)
+
+    async def _counts(self, job_id):
+        rows = await self.db.fetchall("SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,))
+        counts = {'pending': 0, 'sent': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return counts
+
+    async def _edit_progress(self, bot, job_id, requested_by, message_id, counts, text=None):
+        if text is None:
+            total = sum(counts.values())
+            text = f"Broadcast #{job_id}: {counts['sent'] + counts['failed']}/{total} processed, {counts['sent']} sent, {counts['failed']} failed."
+        try:
+            if message_id is not None:
+                await bot.edit_message_text(chat_id=requested_by, message_id=message_id, text=text)
+            else:
+                await bot.send_message(chat_id=requested_by, text=text)
+        except Exception as e:
+            # e.g. "message is not modified" when nothing changed since the last edit
+            logging.debug(f"Failed to update broadcast progress for #{job_id}: {str(e)}")
+
+    def stats(self):
+        return {'running_jobs': len(self._tasks), 'retries': self.retries}
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+
+import metrics
+
+
+# Cache of chat display names (title or username) for the reports.
+# Names are kept in memory and persisted in the users table with the time they were fetched.
+# Fresh entries are served directly, expired ones are served as-is while a background task
+# refreshes them, and unknown chats are fetched concurrently, bounded by a semaphore.
+# Failed lookups (e.g. a group the bot was removed from) are cached too, with their error text,
+# for `error_ttl` seconds, so a dead chat isn't looked up again for every report; they are not persisted.
+class ChatMetaCache:
+    def __init__(self, db, ttl=12 * 3600, concurrency=8, error_ttl=600):
+        self.db = db
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.concurrency = concurrency
+        self._entries = {}  # chat_id -> (name or error text, fetched_at, failed)
+        self._semaphore = None
+        self._refreshing = set()
+        self._tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.errors = 0
+        self.error_hits = 0
+        metrics.gauge('chat_meta_refreshing', lambda: len(self._refreshing), "Chat names being refreshed in the background")
+
+    # Blocking load of the persisted names, for use at startup
+    def load_sync(self):
+        rows = self.db.run_sync(lambda conn: conn.execute("SELECT chat_id, chat_title, meta_updated_at FROM users WHERE chat_title IS NOT NULL").fetchall())
+        for chat_id, name, fetched_at in rows:
+            self._entries[chat_id] = (name, fetched_at or 0, False)
+
+    def _get_semaphore(self):
+        # Created lazily so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    # Look up one chat and cache the result, a failure included; returns the name or the error text
+    async def _fetch(self, bot, chat_id):
+        try:
+            async with self._get_semaphore():
+                chat = await bot.get_chat(chat_id)
+        except Exception as e:
+            self.errors += 1
+            metrics.inc('telegram_errors_total', (('method', 'get_chat'),))
+            name = f"Chat ID: {chat_id} (error fetching details: {str(e)})"
+            self._entries[chat_id] = (name, int(time.time()), True)
+            return name
+        name = chat.title or chat.username or str(chat_id)
+        self._entries[chat_id] = (name, int(time.time()), False)
+        return name
+
+    async def _persist(self, chat_ids):
+        rows = [(self._entries[chat_id][0], self._entries[chat_id][1], chat_id) for chat_id in chat_ids
+                if chat_id in self._entries and not self._entries[chat_id][2]]
+        if rows:
+            await self.db.executemany("UPDATE users SET chat_title = ?, meta_updated_at = ? WHERE chat_id = ?", rows)
+
+    async def _refresh(self, bot, chat_ids):
+        try:
+            await asyncio.gather(*(self._fetch(bot, chat_id) for chat_id in chat_ids))
+            await self._persist(chat_ids)
+        except Exception as e:
+            logging.error(f"Failed to refresh chat names: {str(e)}")
+        finally:
+            self._refreshing.difference_update(chat_ids)
+
+    # Display names for the given chats, as a dict chat_id -> name
+    async def names(self, bot, chat_ids):
+        now = time.time()
+        names = {}
+        missing = []
+        expired = []
+        for chat_id in chat_ids:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                missing.append(chat_id)
+                continue
+            name, fetched_at, failed = entry
+            names[chat_id] = name
+            if now - fetched_at > (self.error_ttl if failed else self.ttl):
+                self.stale += 1
+                if chat_id not in self._refreshing:
+                    expired.append(chat_id)
+            elif failed:
+                self.error_hits += 1
+            else:
+                self.hits += 1
+
+        if expired:
+            # Serve the old names now and refresh them in the background
+            self._refreshing.update(expired)
+            task = asyncio.create_task(self._refresh(bot, expired))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if missing:
+            # Resolve all unknown chats at once, so the wait is one lookup instead of one per chat
+            results = await asyncio.gather(*(self._fetch(bot, chat_id) for chat_id in missing))
+            names.update(zip(missing, results))
+            await self._persist(missing)
+
+        return names
+
+    # Names already in the cache (without fetching or refreshing anything), for all chats or the given ones;
+    # failed lookups are left out
+    def cached(self, chat_ids=None):
+        entries = self._entries.items() if chat_ids is None else ((chat_id, self._entries.get(chat_id)) for chat_id in chat_ids)
+        return {chat_id: entry[0] for chat_id, entry in entries if entry is not None and not entry[2]}
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'errors': self.errors,
+            'error_hits': self.error_hits,
+        }
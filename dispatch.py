@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+# Commands that scan many rows, render files or talk to many chats
+HEAVY_COMMANDS = frozenset({'summary', 'export', 'graph', 'sendmsg', 'verifytotals', 'rebuildtotals', 'deletesummary', 'archive'})
+
+
+# Processes updates concurrently while keeping each chat's updates strictly in arrival order.
+# - updates of one chat (or, without a chat, of one user) run one at a time, in order, so an entry's
+#   reply always shows the total including every earlier entry of that chat
+# - updates of different chats run in parallel: at most `concurrency` in the normal lane and
+#   `heavy_concurrency` heavy commands, so a few slow /summary or /export calls can't occupy every slot
+# - `max_pending` bounds the updates that are running or waiting for their chat (PTB holds that
+#   slot for the whole update, including the wait); one chat can hold at most `max_chat_pending` of
+#   them, so a chat stuck behind a slow /export can't take every slot and stall the other chats.
+#   Its further updates are dropped until it catches up, and the sender is told (through the admission
+#   control's rate-limited notices) that the update wasn't processed.
+# - with an `admission` control (see admission.py), updates are admitted or dropped before they wait
+#   for their chat, so a flood or a pile of repeated /summary requests never queues up
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency=64, heavy_concurrency=4, max_pending=512, max_chat_pending=32, heavy_commands=HEAVY_COMMANDS,
+                 admission=None):
+        super().__init__(max_pending)
+        self.max_chat_pending = max_chat_pending
+        self.heavy_commands = heavy_commands
+        self.admission = admission
+        self._lanes = {'normal': asyncio.Semaphore(concurrency), 'heavy': asyncio.Semaphore(heavy_concurrency)}
+        self._running = {'normal': 0, 'heavy': 0}
+        self._chats = {}  # chat key -> [lock, number of updates holding or waiting for it]
+        metrics.gauge('update_chats_active', lambda: len(self._chats), "Chats with an update running or waiting")
+        metrics.gauge('update_lane_normal_running', lambda: self._running['normal'], "Updates running in the normal lane")
+        metrics.gauge('update_lane_heavy_running', lambda: self._running['heavy'], "Updates running in the heavy lane")
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return ('user', update.effective_user.id)
+        return None
+
+    # Name of the command in a message, e.g. "/summary@SomeBot args" -> "summary" (None for other updates)
+    @staticmethod
+    def _command(update):
+        message = update.effective_message if isinstance(update, Update) else None
+        text = message.text if message is not None else None
+        if text and text.startswith('/'):
+            words = text[1:].split(maxsplit=1)
+            if words:
+                return words[0].split('@', 1)[0].lower()
+        return None
+
+    def _lane(self, update, command):
+        message = update.effective_message if isinstance(update, Update) else None
+        if message is not None and message.document is not None:
+            return 'heavy'  # uploaded files are downloaded and imported
+        return 'heavy' if command in self.heavy_commands else 'normal'
+
+    async def _run(self, lane, coroutine, started):
+        async with self._lanes[lane]:
+            metrics.observe('update_wait_seconds', time.perf_counter() - started, (('lane', lane),))
+            self._running[lane] += 1
+            try:
+                await coroutine
+            finally:
+                self._running[lane] -= 1
+
+    async def do_process_update(self, update, coroutine):
+        started = time.perf_counter()
+        command = self._command(update)
+        admitted = None
+        if self.admission is not None and isinstance(update, Update):
+            reason, admitted = self.admission.admit(update, command)
+            if reason is not None:
+                coroutine.close()  # the handlers never run
+                await self.admission.notify(update, reason, command)
+                return
+        try:
+            await self._process(update, coroutine, command, started)
+        finally:
+            if admitted is not None:
+                self.admission.release(admitted)
+
+    async def _process(self, update, coroutine, command, started):
+        lane = self._lane(update, command)
+        key = self._key(update)
+        if key is None:
+            await self._run(lane, coroutine, started)
+            return
+
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        elif entry[1] >= self.max_chat_pending:
+            coroutine.close()  # the handlers never run
+            metrics.inc('update_dropped_total', (('reason', 'chat_backlog'),))
+            logging.warning(f"Dropped an update for {key}: {entry[1]} of its updates are already running or waiting")
+            if self.admission is not None:
+                await self.admission.notify(update, 'backlog', command)
+            return
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first-come first-served, and PTB starts one task per update in arrival order
+            async with entry[0]:
+                await self._run(lane, coroutine, started)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
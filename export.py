@@ -0,0 +1,129 @@
+import csv
+import gzip
+import io
+import tempfile
+import zipfile
+
+import ledger
+import retention
+
+# Bots may upload files of up to 50 MB; parts are cut a bit earlier to leave room for the last batch
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+SAFETY_MARGIN = 2 * 1024 * 1024
+
+# Rows fetched per query and bytes kept in memory before the buffer spills to a temporary file
+BATCH_SIZE = 2000
+SPOOL_SIZE = 1024 * 1024
+
+HEADER = ["ID", "Amount", "Date", "Category", "Chat ID"]
+COMPRESSIONS = ('gzip', 'zip')
+
+
+# Stream a chat's transactions in (day, id) order, one batch per query, so memory stays flat
+async def iter_batches(db, chat_id, start_day=None, end_day=None, batch_size=BATCH_SIZE):
+    conditions = ["chat_id = ?"]
+    params = [chat_id]
+    if start_day is not None:
+        conditions.append("day >= ?")
+        params.append(start_day)
+    if end_day is not None:
+        conditions.append("day <= ?")
+        params.append(end_day)
+    where = " AND ".join(conditions)
+
+    last = None
+    while True:
+        if last is None:
+            rows = await db.fetchall(f"SELECT id, amount, day, category, chat_id FROM transactions WHERE {where} ORDER BY day, id LIMIT ?",
+                                     (*params, batch_size))
+        else:
+            rows = await db.fetchall(f"SELECT id, amount, day, category, chat_id FROM transactions WHERE {where} AND (day, id) > (?, ?) ORDER BY day, id LIMIT ?",
+                                     (*params, last[2], last[0], batch_size))
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1]
+
+
+# A chat's archived transactions (see retention.py) followed by the ones still in the table.
+# Archived rows are older than the retention period, so the output stays in day order.
+async def iter_history(db, chat_id, start_day=None, end_day=None, batch_size=BATCH_SIZE):
+    async for rows in retention.iter_archived(db, chat_id, start_day, end_day):
+        yield rows
+    async for rows in iter_batches(db, chat_id, start_day, end_day, batch_size):
+        yield rows
+
+
+# One output file: CSV text written through an optional compressor into a spooled buffer
+class _Part:
+    def __init__(self, name, compression):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._archive = None
+        if compression == 'gzip':
+            self.name = name + '.csv.gz'
+            self._raw = gzip.GzipFile(filename=name + '.csv', mode='wb', fileobj=self.buffer)
+        elif compression == 'zip':
+            self.name = name + '.zip'
+            self._archive = zipfile.ZipFile(self.buffer, 'w', compression=zipfile.ZIP_DEFLATED)
+            self._raw = self._archive.open(name + '.csv', 'w', force_zip64=True)
+        else:
+            self.name = name + '.csv'
+            self._raw = self.buffer
+        self._text = io.TextIOWrapper(self._raw, encoding='utf-8', newline='', write_through=True)
+        self.writer = csv.writer(self._text)
+        self.writer.writerow(HEADER)
+        self.rows = 0
+
+    def size(self):
+        return self.buffer.tell()
+
+    # Flush everything into the buffer and rewind it for uploading
+    def finish(self):
+        self._text.flush()
+        self._text.detach()
+        if self._raw is not self.buffer:
+            self._raw.close()
+        if self._archive is not None:
+            self._archive.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+
+# Build the export files for a chat. Yields (filename, file object) one part at a time;
+# a new part is started whenever the current one gets close to the upload limit.
+async def export_parts(db, chat_id, start_day=None, end_day=None, compression=None, max_bytes=TELEGRAM_UPLOAD_LIMIT, batch_size=BATCH_SIZE):
+    base = f"transactions_{chat_id}"
+    if start_day is not None or end_day is not None:
+        base += f"_{ledger.format_day(start_day) or 'start'}_{ledger.format_day(end_day) or 'end'}"
+    limit = max(max_bytes - SAFETY_MARGIN, max_bytes // 2)
+
+    number = 1
+    part = _Part(base, compression)
+    async for rows in iter_history(db, chat_id, start_day, end_day, batch_size):
+        if part.rows and part.size() >= limit:
+            yield part.name, part.finish()
+            number += 1
+            part = _Part(f"{base}_part{number}", compression)
+        part.writer.writerows((id, amount, ledger.format_day(day), category, chat_id) for id, amount, day, category, chat_id in rows)
+        part.rows += len(rows)
+    yield part.name, part.finish()
+
+
+# Parse the /export arguments: optional start and end dates (YYYY-MM-DD) and an optional compression
+def parse_args(args):
+    days = []
+    compression = None
+    for arg in args:
+        if arg.lower() in COMPRESSIONS or arg.lower() == 'gz':
+            compression = 'gzip' if arg.lower() == 'gz' else arg.lower()
+        else:
+            days.append(ledger.parse_day(arg))
+    if len(days) > 2:
+        raise ValueError("Too many dates.")
+    start_day = days[0] if days else None
+    end_day = days[1] if len(days) > 1 else None
+    if start_day is not None and end_day is not None and start_day > end_day:
+        raise ValueError("The start date is after the end date.")
+    return start_day, end_day, compression
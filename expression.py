@@ -0,0 +1,100 @@
+import ast
+import operator
+import re
+from functools import lru_cache
+
+# Limits that keep a single message from tying up the bot
+MAX_LENGTH = 200           # characters in the cleaned expression
+MAX_NODES = 100            # AST nodes in the parsed expression
+MAX_LITERAL_DIGITS = 15    # digits in any single number
+MAX_MAGNITUDE = 1e15       # absolute value of any literal or intermediate result
+
+# Cache size for evaluated expressions (teams repeat the same entries all the time)
+CACHE_SIZE = 4096
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant) + tuple(_BINARY_OPERATORS) + tuple(_UNARY_OPERATORS)
+
+_DISALLOWED_CHARACTERS = re.compile(r'[^0-9\.\+\-\*/\(\) ]')
+
+
+# Raised for anything that is not a small, valid arithmetic expression
+class ExpressionError(ValueError):
+    pass
+
+
+# Strip everything except numbers and basic arithmetic operators from a message
+def clean(text):
+    return _DISALLOWED_CHARACTERS.sub('', text)
+
+
+def _check_magnitude(value):
+    if abs(value) > MAX_MAGNITUDE:
+        raise ExpressionError("Number is too large.")
+    return value
+
+
+def _evaluate_node(node):
+    if isinstance(node, ast.Expression):
+        return _evaluate_node(node.body)
+    if isinstance(node, ast.Constant):
+        return _check_magnitude(node.value)
+    if isinstance(node, ast.UnaryOp):
+        return _UNARY_OPERATORS[type(node.op)](_evaluate_node(node.operand))
+    if isinstance(node, ast.BinOp):
+        left = _evaluate_node(node.left)
+        right = _evaluate_node(node.right)
+        try:
+            return _check_magnitude(_BINARY_OPERATORS[type(node.op)](left, right))
+        except ZeroDivisionError:
+            raise ExpressionError("Division by zero.")
+    raise ExpressionError("Unsupported expression.")
+
+
+# Parse an expression and make sure it only contains + - * / (), parentheses and small numbers
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_expression(text):
+    if len(text) > MAX_LENGTH:
+        raise ExpressionError("Expression is too long.")
+    for literal in re.findall(r'[0-9\.]+', text):
+        if len(literal.replace('.', '')) > MAX_LITERAL_DIGITS:
+            raise ExpressionError("Number is too large.")
+
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        raise ExpressionError("Invalid arithmetic expression.")
+
+    count = 0
+    for node in ast.walk(tree):
+        count += 1
+        if count > MAX_NODES:
+            raise ExpressionError("Expression is too complex.")
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ExpressionError("Unsupported expression.")
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+            raise ExpressionError("Unsupported expression.")
+    return tree
+
+
+# Evaluate an already cleaned expression such as "+20*5" or "-10/2", returns an int or float
+@lru_cache(maxsize=CACHE_SIZE)
+def evaluate(text):
+    return _evaluate_node(compile_expression(text))
+
+
+# Drop both caches (e.g. for benchmarks)
+def cache_clear():
+    compile_expression.cache_clear()
+    evaluate.cache_clear()
@@ -0,0 +1,140 @@
+import asyncio
+import io
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import ledger
+
+VARIANTS = ('daily', 'cumulative')
+
+
+# Draw a chart and return it as PNG bytes.
+# Runs in a worker process and only uses Matplotlib's object-oriented API (no pyplot global state),
+# so every call starts from a fresh figure that is freed as soon as it is rendered.
+def render_png(variant, days, values, title):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    labels = [ledger.format_day(day) for day in days]
+    figure = Figure(figsize=(8, 4.5), dpi=100)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    if variant == 'cumulative':
+        axes.plot(labels, values, marker='.')
+        axes.set_ylabel('Balance')
+    else:
+        axes.bar(labels, values)
+        axes.set_ylabel('Total Amount')
+    axes.set_title(title)
+    axes.set_xlabel('Date')
+    axes.tick_params(axis='x', labelrotation=45, labelsize=8)
+    if len(labels) > 15:
+        # Keep the date axis readable for long histories
+        step = len(labels) // 15 + 1
+        axes.set_xticks(range(0, len(labels), step))
+        axes.set_xticklabels(labels[::step])
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+# Renders /graph charts in a pool of worker processes, off the event loop.
+# Results are cached by (chat_id, last transaction id, variant, range): as long as no transaction
+# was added or removed, repeating a request costs nothing. Identical requests that arrive while a
+# chart is being drawn wait for the same render.
+class GraphRenderer:
+    def __init__(self, ledger_backend, workers=2, cache_size=128):
+        self.ledger_backend = ledger_backend
+        self.workers = workers
+        self.cache_size = cache_size
+        self._pool = None
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn: don't fork a process that is running database and event loop threads
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def _load(self, chat_id, variant, start_day, end_day):
+        db = self.ledger_backend.storage(chat_id)
+        conditions = ["chat_id = ?"]
+        params = [chat_id]
+        if start_day is not None:
+            conditions.append("day >= ?")
+            params.append(start_day)
+        if end_day is not None:
+            conditions.append("day <= ?")
+            params.append(end_day)
+        # daily_totals has one row per chat and day, so this costs one row per day in the range
+        rows = await db.fetchall(f"SELECT day, sum FROM daily_totals WHERE {' AND '.join(conditions)} ORDER BY day", params)
+        days = [row[0] for row in rows]
+        values = [row[1] for row in rows]
+        if variant == 'cumulative':
+            # Start from the balance before the range, so the line shows the real running total
+            before = 0
+            if start_day is not None:
+                before = (await db.fetchone("SELECT COALESCE(SUM(sum), 0) FROM daily_totals WHERE chat_id = ? AND day < ?", (chat_id, start_day)))[0]
+            running = []
+            for value in values:
+                before += value
+                running.append(before)
+            values = running
+        return days, values
+
+    async def _render(self, chat_id, variant, start_day, end_day):
+        days, values = await self._load(chat_id, variant, start_day, end_day)
+        if not days:
+            return None
+        title = 'Transaction History' if variant == 'daily' else 'Balance History'
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), render_png, variant, days, values, title)
+
+    # PNG bytes for the chart, or None when there is nothing to draw
+    async def render(self, chat_id, last_id, variant='daily', start_day=None, end_day=None):
+        key = (chat_id, last_id, variant, start_day, end_day)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._render(chat_id, variant, start_day, end_day))
+            self._inflight[key] = future
+            try:
+                png = await future
+            finally:
+                del self._inflight[key]
+            self._cache[key] = png
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return png
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+# Parse the /graph arguments: an optional variant and an optional range (see ledger.parse_range)
+def parse_args(args):
+    variant = 'daily'
+    rest = []
+    for arg in args:
+        if arg.lower() in VARIANTS:
+            variant = arg.lower()
+        else:
+            rest.append(arg)
+    start_day, end_day, _ = ledger.parse_range(rest)
+    return variant, start_day, end_day
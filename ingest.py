@@ -0,0 +1,195 @@
+import csv
+import gzip
+import io
+import re
+import zipfile
+
+import expression
+import ledger
+
+# Entries accepted from one message or file
+MAX_ROWS = 200000
+# Lines (including blank and rejected ones) and uncompressed bytes read from one file, so a wrong or
+# hostile upload that decompresses to gigabytes is given up on early
+MAX_LINES = 400000
+MAX_TEXT_BYTES = 64 * 1024 * 1024
+# Rejected lines listed in the reply; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+MAX_CATEGORY_LENGTH = 64
+DEFAULT_CATEGORY = 'general'
+
+UPLOAD_SUFFIXES = ('.csv', '.csv.gz', '.gz', '.zip')
+
+_DATE = re.compile(r'(?<![\d-])(\d{4}-\d{2}-\d{2})(?![\d-])')
+_ENTRY = re.compile(r'\s*([+-][0-9\.\+\-\*/\(\) ]*)(.*)')
+
+
+# Result of parsing one message or file: entries ready for ledger.add_transactions and the rejected lines
+class Batch:
+    def __init__(self, chat_id, max_rows=MAX_ROWS):
+        self.chat_id = chat_id
+        self.max_rows = max_rows
+        self.entries = []
+        self.errors = []  # (line number, message) of the first MAX_REPORTED_ERRORS rejected lines
+        self.rejected = 0
+        self.truncated = False
+        self.lines_exceeded = None  # the line limit, once reading stopped at it
+        self._days = {}
+
+    def _day(self, text):
+        # The same few dates repeat on most lines, and strptime is the slowest part of a row
+        day = self._days.get(text)
+        if day is None:
+            try:
+                day = self._days[text] = ledger.parse_day(text)
+            except ValueError:
+                raise ValueError(f"Invalid date {text}, expected YYYY-MM-DD.")
+        return day
+
+    def _reject(self, number, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((number, message))
+
+    # Add one entry, returns False once the batch is full
+    def _add(self, amount, day, category):
+        if len(self.entries) >= self.max_rows:
+            self.truncated = True
+            return False
+        self.entries.append((self.chat_id, amount, day, category[:MAX_CATEGORY_LENGTH] or DEFAULT_CATEGORY))
+        return True
+
+    # One "+expression [category] [YYYY-MM-DD]" line, e.g. "-12.5*2 lunch 2024-05-01"
+    def add_line(self, number, line, today):
+        day = today
+        match = _DATE.search(line)
+        try:
+            if match:
+                day = self._day(match.group(1))
+                line = line[:match.start()] + line[match.end():]
+            entry = _ENTRY.fullmatch(line)
+            if entry is None:
+                raise ValueError("Expected an amount starting with + or -.")
+            amount = expression.evaluate(expression.clean(entry.group(1)))
+        except (ValueError, ArithmeticError) as e:
+            self._reject(number, str(e) or "Invalid entry.")
+            return True
+        return self._add(amount, day, ' '.join(entry.group(2).split()))
+
+    # One CSV row in /export's layout (ID, Amount, Date, Category, Chat ID); columns are found by the header if there is one
+    def add_row(self, number, row, columns, today):
+        try:
+            text = row[columns['amount']]
+            try:
+                amount = float(text)
+            except ValueError:
+                raise ValueError(f"Invalid amount {text!r}.")
+            if amount != amount or abs(amount) > expression.MAX_MAGNITUDE:
+                raise ValueError("Number is too large.")
+            date = row[columns['date']].strip() if columns['date'] < len(row) else ''
+            day = self._day(date) if date else today
+        except IndexError:
+            self._reject(number, "Missing the amount column.")
+            return True
+        except ValueError as e:
+            self._reject(number, str(e))
+            return True
+        category = row[columns['category']].strip() if columns['category'] < len(row) else ''
+        return self._add(amount, day, category)
+
+    # Text of the reply's error section
+    def error_report(self, max_errors=MAX_REPORTED_ERRORS):
+        lines = [f"Line {number}: {message}" for number, message in self.errors[:max_errors]]
+        if self.rejected > len(lines):
+            lines.append(f"... and {self.rejected - len(lines)} more")
+        if self.truncated:
+            lines.append(f"Stopped after {self.max_rows} entries; send the rest separately.")
+        if self.lines_exceeded:
+            lines.append(f"Stopped reading after {self.lines_exceeded} lines; send the rest separately.")
+        return "\n".join(lines)
+
+
+# Whether an entry line has a category or a date, e.g. "+10 lunch 2024-05-01" (a plain "+20*5" has neither)
+def has_details(line):
+    if _DATE.search(line):
+        return True
+    entry = _ENTRY.fullmatch(line)
+    return entry is not None and entry.group(2).strip() != ''
+
+
+# Parse a multi-line message; blank lines are skipped
+def parse_lines(text, chat_id, today, max_rows=MAX_ROWS):
+    batch = Batch(chat_id, max_rows)
+    for number, line in enumerate(text.splitlines(), 1):
+        if line.strip() and not batch.add_line(number, line, today):
+            break
+    return batch
+
+
+def _columns(header):
+    names = [name.strip().lower() for name in header]
+    if 'amount' not in names:
+        return None
+    return {key: names.index(key) if key in names else len(names) for key in ('amount', 'date', 'category')}
+
+
+# Reads through a stream and fails once more than `limit` bytes came out of it
+class _LimitedReader(io.RawIOBase):
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.limit = limit
+        self.read_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.raw.readinto(buffer)
+        self.read_bytes += count
+        if self.read_bytes > self.limit:
+            raise ValueError(f"The file is larger than {self.limit // (1024 * 1024)} MB uncompressed, split it into smaller files.")
+        return count
+
+
+# Decompressed text of an upload, read as it is parsed (gzip, zip with one CSV inside, or plain CSV)
+def _open_text(data, filename, max_bytes):
+    raw = io.BytesIO(data)
+    name = filename.lower()
+    if name.endswith('.gz'):
+        raw = gzip.GzipFile(fileobj=raw)
+    elif name.endswith('.zip'):
+        archive = zipfile.ZipFile(raw)
+        members = [member for member in archive.namelist() if member.lower().endswith('.csv')]
+        if not members:
+            raise ValueError("The zip file doesn't contain a CSV file.")
+        raw = archive.open(members[0])
+    # utf-8-sig: spreadsheet programs often start the file with a byte order mark
+    return io.TextIOWrapper(io.BufferedReader(_LimitedReader(raw, max_bytes)), encoding='utf-8-sig', newline='')
+
+
+# Parse an uploaded CSV file in the layout /export produces; the Chat ID column is ignored and every row
+# goes to the chat the file was sent in. Raises ValueError if the file can't be read at all or is too large uncompressed.
+def parse_upload(data, filename, chat_id, today, max_rows=MAX_ROWS, max_lines=MAX_LINES, max_bytes=MAX_TEXT_BYTES):
+    batch = Batch(chat_id, max_rows)
+    try:
+        reader = csv.reader(_open_text(data, filename, max_bytes))
+        # Without a header the columns are in /export's order: ID, Amount, Date, Category, Chat ID
+        columns = {'amount': 1, 'date': 2, 'category': 3}
+        first = True
+        for row in reader:
+            if reader.line_num > max_lines:
+                batch.lines_exceeded = max_lines
+                break
+            if not any(field.strip() for field in row):
+                continue
+            if first:
+                first = False
+                header = _columns(row)
+                if header is not None:
+                    columns = header
+                    continue
+            if not batch.add_row(reader.line_num, row, columns, today):
+                break
+    except (OSError, EOFError, UnicodeDecodeError, zipfile.BadZipFile, csv.Error) as e:
+        raise ValueError(f"Couldn't read {filename}: {str(e)}")
+    return batch
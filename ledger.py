@@ -0,0 +1,173 @@
+import time
+from datetime import date, datetime, timedelta
+
+
+# Write-side helpers for the transactions ledger.
+# Every function takes an open connection and is meant to run inside Storage.transaction(),
+# so the aggregates in chat_totals (per chat) and daily_totals (per chat and day) always change
+# in the same transaction as the rows they summarize.
+
+# Named ranges accepted by parse_range, with how they are written in replies
+RANGES = {
+    'today': "today",
+    'yesterday': "yesterday",
+    'week': "this week",
+    'month': "this month",
+    'year': "this year",
+}
+
+# Live and archived transactions as (chat_id, day, sum, count, last_id) per chat and day
+LEDGER_DAYS = '''SELECT chat_id, day, SUM(amount) AS sum, COUNT(*) AS count, MAX(id) AS last_id FROM transactions
+                 WHERE chat_id IS NOT NULL GROUP BY chat_id, day
+                 UNION ALL
+                 SELECT chat_id, day, sum, count, NULL FROM archived_totals'''
+
+# Days are stored as integers in YYYYMMDD form (sortable and compact)
+def to_day(value):
+    return value.year * 10000 + value.month * 100 + value.day
+
+# Today's day number
+def today():
+    return to_day(datetime.now())
+
+# Parse a YYYY-MM-DD string into a day number
+def parse_day(text):
+    return to_day(datetime.strptime(text, "%Y-%m-%d"))
+
+# Format a day number as YYYY-MM-DD
+def format_day(day):
+    if day is None:
+        return ""
+    return date(day // 10000, day // 100 % 100, day % 100).isoformat()
+
+# Parse a date range: a named range (today, yesterday, week, month, year), the last N days
+# ("30d" or "last30"), or one or two YYYY-MM-DD dates. Returns (start_day, end_day, label),
+# where an open end is None. Raises ValueError for anything else.
+def parse_range(args, now=None):
+    current = (now or datetime.now()).date()
+    name = args[0].lower() if len(args) == 1 else None
+    starts = {
+        'today': current,
+        'yesterday': current - timedelta(days=1),
+        'week': current - timedelta(days=current.weekday()),
+        'month': current.replace(day=1),
+        'year': current.replace(month=1, day=1),
+    }
+    if name in starts:
+        end = starts['yesterday'] if name == 'yesterday' else current
+        return to_day(starts[name]), to_day(end), RANGES[name]
+    if name and name.startswith('last'):
+        name = name[4:] + 'd'
+    if name and name.endswith('d') and name[:-1].isdigit():
+        count = int(name[:-1])
+        if not 1 <= count <= 3660:
+            raise ValueError("The number of days must be between 1 and 3660.")
+        return to_day(current - timedelta(days=count - 1)), to_day(current), f"the last {count} day(s)"
+
+    if len(args) > 2:
+        raise ValueError("Too many dates.")
+    days = [parse_day(arg) for arg in args]
+    start_day = days[0] if days else None
+    end_day = days[1] if len(days) > 1 else None
+    if start_day is not None and end_day is not None and start_day > end_day:
+        raise ValueError("The start date is after the end date.")
+    if start_day is None:
+        label = "all time"
+    elif end_day is None:
+        label = f"since {format_day(start_day)}"
+    else:
+        label = f"{format_day(start_day)} to {format_day(end_day)}"
+    return start_day, end_day, label
+
+# Insert many transactions with one executemany and update every affected chat's total and day once.
+# entries are (chat_id, amount, day, category); returns the running total after each entry, in order.
+def add_transactions(conn, entries):
+    conn.executemany('INSERT INTO transactions (chat_id, amount, day, category) VALUES (?, ?, ?, ?)', entries)
+    # The writer holds the write lock, so the new rows got consecutive IDs ending at last_insert_rowid()
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    first_id = last_id - len(entries) + 1
+
+    chat_ids = {entry[0] for entry in entries}
+    placeholders = ', '.join('?' * len(chat_ids))
+    totals = dict(conn.execute(f'SELECT chat_id, total FROM chat_totals WHERE chat_id IN ({placeholders})', tuple(chat_ids)).fetchall())
+
+    results = []
+    changes = {}
+    daily = {}
+    for offset, (chat_id, amount, day, category) in enumerate(entries):
+        total = totals.get(chat_id, 0.0) + amount
+        totals[chat_id] = total
+        results.append(total)
+        count = changes[chat_id][1] if chat_id in changes else 0
+        changes[chat_id] = (total, count + 1, first_id + offset)
+        day_sum, day_count = daily.get((chat_id, day), (0.0, 0))
+        daily[(chat_id, day)] = (day_sum + amount, day_count + 1)
+
+    now = int(time.time())
+    conn.executemany('''INSERT INTO chat_totals (chat_id, total, count, last_activity, last_id) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(chat_id) DO UPDATE SET total = excluded.total,
+                                                           count = count + excluded.count,
+                                                           last_activity = excluded.last_activity,
+                                                           last_id = excluded.last_id''',
+                     [(chat_id, total, count, now, row_id) for chat_id, (total, count, row_id) in changes.items()])
+    conn.executemany('''INSERT INTO daily_totals (chat_id, day, sum, count) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(chat_id, day) DO UPDATE SET sum = sum + excluded.sum, count = count + excluded.count''',
+                     [(chat_id, day, day_sum, day_count) for (chat_id, day), (day_sum, day_count) in daily.items()])
+    return results
+
+# Delete all transactions of one chat together with its totals.
+# Archived rows stay in their files but are no longer listed for the chat, so exports skip them.
+def reset_chat(conn, chat_id):
+    conn.execute('DELETE FROM transactions WHERE chat_id = ?', (chat_id,))
+    conn.execute('DELETE FROM chat_totals WHERE chat_id = ?', (chat_id,))
+    conn.execute('DELETE FROM daily_totals WHERE chat_id = ?', (chat_id,))
+    conn.execute('DELETE FROM archived_totals WHERE chat_id = ?', (chat_id,))
+    conn.execute('DELETE FROM archive_members WHERE chat_id = ?', (chat_id,))
+
+# Delete every transaction and every total (archive files are left alone, as in reset_chat)
+def delete_all(conn):
+    conn.execute('DELETE FROM transactions')
+    conn.execute('DELETE FROM chat_totals')
+    conn.execute('DELETE FROM daily_totals')
+    conn.execute('DELETE FROM archived_totals')
+    conn.execute('DELETE FROM archive_members')
+
+# Recompute chat_totals from scratch out of the transactions and the archived totals, returns the number of chats.
+# Rows are updated in place, so the stored chat names and activity times survive.
+def rebuild_totals(conn):
+    conn.execute(f'''INSERT INTO chat_totals (chat_id, total, count, last_activity, last_id)
+                     SELECT chat_id, SUM(sum), SUM(count), ?, MAX(last_id) FROM ({LEDGER_DAYS}) WHERE true GROUP BY chat_id
+                     ON CONFLICT(chat_id) DO UPDATE SET total = excluded.total,
+                                                        count = excluded.count,
+                                                        last_id = excluded.last_id''', (int(time.time()),))
+    conn.execute(f'DELETE FROM chat_totals WHERE chat_id NOT IN (SELECT chat_id FROM ({LEDGER_DAYS}))')
+    return conn.execute('SELECT COUNT(*) FROM chat_totals').fetchone()[0]
+
+# Recompute daily_totals from scratch out of the transactions and the archived totals, returns the number of (chat, day) rows
+def rebuild_daily_totals(conn):
+    conn.execute('DELETE FROM daily_totals')
+    conn.execute(f'''INSERT INTO daily_totals (chat_id, day, sum, count)
+                     SELECT chat_id, day, SUM(sum), SUM(count) FROM ({LEDGER_DAYS}) WHERE day IS NOT NULL GROUP BY chat_id, day''')
+    return conn.execute('SELECT COUNT(*) FROM daily_totals').fetchone()[0]
+
+# Sum and number of a chat's transactions between two days (either end may be None), read from daily_totals
+def range_total(conn, chat_id, start_day=None, end_day=None):
+    return conn.execute('''SELECT COALESCE(SUM(sum), 0), COALESCE(SUM(count), 0) FROM daily_totals
+                           WHERE chat_id = ? AND day >= ? AND day <= ?''',
+                        (chat_id, start_day or 0, end_day or 99991231)).fetchone()
+
+# Compare chat_totals with the real sums, archived transactions included (read-only, can run through Storage.read),
+# returns a list of (chat_id, stored_total, actual_total) that differ
+def verify_totals(conn, tolerance=1e-6):
+    rows = conn.execute(f'''SELECT s.chat_id, t.total, s.total
+                            FROM (SELECT chat_id, SUM(sum) AS total FROM ({LEDGER_DAYS}) GROUP BY chat_id) AS s
+                            LEFT JOIN chat_totals AS t ON t.chat_id = s.chat_id
+                            UNION ALL
+                            SELECT chat_id, total, NULL FROM chat_totals
+                            WHERE chat_id NOT IN (SELECT chat_id FROM transactions WHERE chat_id IS NOT NULL
+                                                  UNION SELECT chat_id FROM archived_totals)''').fetchall()
+    mismatches = []
+    for chat_id, stored, actual in rows:
+        if stored is None or actual is None or abs(stored - actual) > tolerance:
+            mismatches.append((chat_id, stored, actual))
+    return mismatches
@@ -0,0 +1,187 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+# In-process metrics: counters, latency histograms and gauges, rendered for the /stats command
+# and (optionally) as Prometheus text on a local HTTP endpoint.
+# Recording is a dict lookup plus a bisect, cheap enough for the message hot path.
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> Histogram
+_gauges = {}      # name -> function returning the current value
+_help = {}        # name -> description
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Approximate quantile: upper bound of the bucket the quantile falls into
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[index] if index < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def inc(name, labels=(), value=1):
+    key = (name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, labels=()):
+    key = (name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+
+# Register a gauge whose value is read when metrics are rendered (e.g. a queue depth)
+def gauge(name, fn, text=None):
+    _gauges[name] = fn
+    if text:
+        _help[name] = text
+
+
+# Decorator for handlers: records latency per handler and counts the ones that raised
+def timed(fn):
+    labels = (('handler', fn.__name__),)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            inc('handler_errors_total', labels)
+            raise
+        finally:
+            observe('handler_latency_seconds', time.perf_counter() - started, labels)
+    return wrapper
+
+
+# Callback for Storage.on_query: timing of every database call, labelled by operation and statement
+def observe_query(operation, statement, seconds):
+    observe('db_query_seconds', seconds, (('op', operation), ('query', statement)))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')) for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _gauge_values():
+    values = {}
+    for name, fn in _gauges.items():
+        try:
+            values[name] = fn()
+        except Exception as e:
+            logging.error(f"Failed to read gauge {name}: {str(e)}")
+    return values
+
+
+# Prometheus text exposition format
+def render_prometheus():
+    lines = []
+    emitted = set()
+
+    def header(name, kind):
+        if name not in emitted:
+            emitted.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(_counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name, value in sorted(_gauge_values().items()):
+        header(name, 'gauge')
+        lines.append(f"{name} {value}")
+    for (name, labels), histogram in sorted(_histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return '\n'.join(lines) + '\n'
+
+
+def _format_ms(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return f'>{BUCKETS[-1] * 1000:.0f}ms'
+    return f'{seconds * 1000:g}ms'
+
+
+# Short human-readable summary for the /stats command
+def render_text(max_queries=10):
+    lines = ["Counters:"]
+    for (name, labels), value in sorted(_counters.items()):
+        lines.append(f"  {name}{_format_labels(labels)}: {value}")
+    lines.append("Gauges:")
+    for name, value in sorted(_gauge_values().items()):
+        lines.append(f"  {name}: {value}")
+
+    lines.append("Handler latency (count, avg, p50, p99):")
+    for (name, labels), histogram in sorted(_histograms.items()):
+        if name == 'handler_latency_seconds':
+            lines.append(f"  {dict(labels)['handler']}: {histogram.count}, {_format_ms(histogram.sum / histogram.count)}, "
+                         f"{_format_ms(histogram.quantile(0.5))}, {_format_ms(histogram.quantile(0.99))}")
+
+    queries = [(labels, histogram) for (name, labels), histogram in _histograms.items() if name == 'db_query_seconds']
+    queries.sort(key=lambda item: item[1].sum, reverse=True)
+    lines.append(f"Slowest queries by total time (top {max_queries}: count, avg, p99):")
+    for labels, histogram in queries[:max_queries]:
+        label = dict(labels)
+        lines.append(f"  {label['op']} {label['query']}: {histogram.count}, {_format_ms(histogram.sum / histogram.count)}, {_format_ms(histogram.quantile(0.99))}")
+    return '\n'.join(lines)
+
+
+# Optional local HTTP endpoint serving render_prometheus() on any path
+async def start_http_server(host, port):
+    async def handle(reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            body = render_prometheus().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,218 @@
+import logging
+import sqlite3
+import time
+
+# Versioned schema migrations.
+# Every migration is a function taking an open connection; they are applied in version order,
+# each one in its own transaction, and recorded in the schema_version table.
+# Migrations only use their own SQL (never helpers from other modules), so an old database
+# is upgraded the same way no matter how the rest of the code has changed since.
+MIGRATIONS = []
+
+
+# Register a migration under the given version number
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def _create_version_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                 (version INTEGER PRIMARY KEY,
+                  description TEXT,
+                  applied_at INTEGER)''')
+
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+# Highest applied migration version (0 for a database that was never migrated)
+def current_version(conn):
+    if not _table_exists(conn, 'schema_version'):
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+# Migrations that still have to be applied, as (version, description) pairs
+def pending(conn):
+    version = current_version(conn)
+    return [(v, description) for v, description, _ in MIGRATIONS if v > version]
+
+
+def _apply(conn, version, description, fn):
+    _create_version_table(conn)
+    # Another process may have applied it in the meantime
+    if current_version(conn) >= version:
+        return False
+    fn(conn)
+    conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)", (version, description, int(time.time())))
+    return True
+
+
+# Apply every pending migration through the storage layer's writer, returns the list of applied versions
+def migrate(db):
+    applied = []
+    for version, description in db.run_sync(pending):
+        fn = next(fn for v, _, fn in MIGRATIONS if v == version)
+        started = time.monotonic()
+        if db.run_sync(_apply, version, description, fn):
+            logging.info(f"Applied migration {version} ({description}) in {time.monotonic() - started:.2f}s")
+            applied.append(version)
+    return applied
+
+
+@migration(1, "base tables")
+def _base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                 (chat_id INTEGER PRIMARY KEY,
+                  username TEXT,
+                  is_admin BOOLEAN DEFAULT 0,
+                  chat_type TEXT)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS transactions
+                 (id INTEGER PRIMARY KEY,
+                  amount REAL,
+                  date TEXT,
+                  category TEXT,
+                  chat_id INTEGER)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS report_times
+                 (chat_id INTEGER PRIMARY KEY,
+                  hour INTEGER,
+                  minute INTEGER)''')
+
+    # Databases created by old versions of the bot may miss these columns
+    for column in ("is_admin BOOLEAN DEFAULT 0", "chat_type TEXT DEFAULT 'private'"):
+        try:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            # Ignore if the column already exists
+            pass
+
+
+@migration(2, "per-chat running totals")
+def _chat_totals(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_totals
+                 (chat_id INTEGER PRIMARY KEY,
+                  total REAL NOT NULL DEFAULT 0,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  last_activity INTEGER)''')
+    conn.execute("DELETE FROM chat_totals")
+    conn.execute('''INSERT INTO chat_totals (chat_id, total, count, last_activity)
+                    SELECT chat_id, SUM(amount), COUNT(*), CAST(strftime('%s', 'now') AS INTEGER) FROM transactions GROUP BY chat_id''')
+
+
+@migration(3, "compact sortable day column and indexes")
+def _transactions_day_and_indexes(conn):
+    # Rebuild transactions with a fixed column order and the date stored as an integer YYYYMMDD,
+    # which sorts correctly, takes a few bytes and can be range-scanned through the index
+    sequence = None
+    if _table_exists(conn, 'sqlite_sequence'):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()
+        sequence = row[0] if row else None
+
+    conn.execute('''CREATE TABLE transactions_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  amount REAL,
+                  day INTEGER,
+                  category TEXT,
+                  chat_id INTEGER)''')
+    conn.execute('''INSERT INTO transactions_new (id, amount, day, category, chat_id)
+                    SELECT id, amount, CAST(strftime('%Y%m%d', date) AS INTEGER), category, chat_id FROM transactions''')
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    if sequence is not None:
+        # Never hand out IDs of rows that were deleted before the rebuild
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'transactions'", (sequence,))
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_chat_day ON transactions (chat_id, day)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+
+
+@migration(4, "cached chat titles")
+def _chat_titles(conn):
+    conn.execute("ALTER TABLE users ADD COLUMN chat_title TEXT")
+    conn.execute("ALTER TABLE users ADD COLUMN meta_updated_at INTEGER")
+
+
+@migration(5, "broadcast jobs")
+def _broadcast_jobs(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  message TEXT,
+                  requested_by INTEGER,
+                  progress_message_id INTEGER,
+                  status TEXT,
+                  created_at INTEGER,
+                  finished_at INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+                 (job_id INTEGER,
+                  chat_id INTEGER,
+                  status TEXT,
+                  error TEXT,
+                  PRIMARY KEY (job_id, chat_id)) WITHOUT ROWID''')
+
+
+@migration(6, "last sent day of daily reports")
+def _report_last_sent(conn):
+    conn.execute("ALTER TABLE report_times ADD COLUMN last_sent_day INTEGER")
+
+
+@migration(7, "last transaction ID per chat")
+def _chat_totals_last_id(conn):
+    conn.execute("ALTER TABLE chat_totals ADD COLUMN last_id INTEGER")
+    conn.execute('''UPDATE chat_totals SET last_id = (SELECT MAX(id) FROM transactions WHERE transactions.chat_id = chat_totals.chat_id)''')
+
+
+@migration(8, "per-day totals")
+def _daily_totals(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS daily_totals
+                 (chat_id INTEGER NOT NULL,
+                  day INTEGER NOT NULL,
+                  sum REAL NOT NULL,
+                  count INTEGER NOT NULL,
+                  PRIMARY KEY (chat_id, day)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_totals_day ON daily_totals (day)")
+    conn.execute('''INSERT INTO daily_totals (chat_id, day, sum, count)
+                    SELECT chat_id, day, SUM(amount), COUNT(*) FROM transactions
+                    WHERE chat_id IS NOT NULL AND day IS NOT NULL GROUP BY chat_id, day''')
+
+
+@migration(9, "transaction archive")
+def _transaction_archive(conn):
+    # Sum and number of the archived transactions per chat and day, so totals can still be checked and rebuilt
+    conn.execute('''CREATE TABLE IF NOT EXISTS archived_totals
+                 (chat_id INTEGER NOT NULL,
+                  day INTEGER NOT NULL,
+                  sum REAL NOT NULL,
+                  count INTEGER NOT NULL,
+                  PRIMARY KEY (chat_id, day)) WITHOUT ROWID''')
+    # Where a chat's archived rows are: one gzip member (offset and size in the file) per archiving batch
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_members
+                 (chat_id INTEGER NOT NULL,
+                  month INTEGER NOT NULL,
+                  file TEXT NOT NULL,
+                  offset INTEGER NOT NULL,
+                  size INTEGER NOT NULL,
+                  PRIMARY KEY (chat_id, file, offset)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_members_chat_month ON archive_members (chat_id, month)")
+    # The monthly files this database appends to, with the size of their committed part
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_files
+                 (file TEXT PRIMARY KEY,
+                  month INTEGER NOT NULL,
+                  bytes INTEGER NOT NULL)''')
+
+
+@migration(10, "chat summary ordering")
+def _chat_summary_ordering(conn):
+    # Display name copied from the chat name cache, so /summary can page through chats by name
+    conn.execute("ALTER TABLE chat_totals ADD COLUMN name TEXT NOT NULL DEFAULT '' COLLATE NOCASE")
+    conn.execute("UPDATE chat_totals SET last_activity = 0 WHERE last_activity IS NULL")
+    # One index per /summary sort order; each page is a range scan from the last row of the previous one
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_totals_total ON chat_totals (total, chat_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_totals_activity ON chat_totals (last_activity, chat_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_totals_name ON chat_totals (name, chat_id)")
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import ledger
+
+
+# Schedules the daily reports.
+# - one cron job per subscriber, with the job ID derived from the chat ID, so /setreporttime
+#   replaces the subscriber's job on the fly instead of needing a restart
+# - the data for a report (the "snapshot") is computed once per time slot and shared by every
+#   subscriber whose report fires in that slot; runs that overlap wait for the same computation
+# - report times and the day each report was last sent are stored in report_times, so a restart
+#   neither sends a report twice nor silently skips one whose time passed while the bot was down
+class ReportScheduler:
+    def __init__(self, db, build_snapshot, send_report, catch_up=timedelta(hours=6)):
+        self.db = db
+        self.build_snapshot = build_snapshot
+        self.send_report = send_report
+        self.catch_up = catch_up
+        self.times = {}        # chat_id -> (hour, minute)
+        self.last_sent = {}    # chat_id -> day number of the last report sent
+        self.snapshots_built = 0
+        self.reports_sent = 0
+        self._snapshots = {}   # (day, hour, minute) -> task computing the snapshot
+        self._sending = set()  # chat IDs whose report is being sent right now
+        self._scheduler = None
+        self._bot = None
+
+    # Blocking load of the persisted report times, for use at startup
+    def load_sync(self):
+        rows = self.db.run_sync(lambda conn: conn.execute("SELECT chat_id, hour, minute, last_sent_day FROM report_times").fetchall())
+        for chat_id, hour, minute, last_sent_day in rows:
+            self.times[chat_id] = (hour, minute)
+            self.last_sent[chat_id] = last_sent_day
+
+    # Start the scheduler in the running event loop and send reports missed while the bot was down
+    def start(self, bot):
+        # Imported here: tools that only touch the stored report times don't need APScheduler
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+        self._bot = bot
+        self._scheduler = AsyncIOScheduler(event_loop=asyncio.get_running_loop())
+        for chat_id, (hour, minute) in self.times.items():
+            self._add_job(chat_id, hour, minute)
+        self._scheduler.start()
+
+        now = datetime.now()
+        for chat_id, (hour, minute) in self.times.items():
+            slot = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if slot <= now <= slot + self.catch_up and self.last_sent.get(chat_id) != ledger.to_day(now):
+                logging.info(f"Sending missed daily report to {chat_id}")
+                self._scheduler.add_job(self._fire, args=[chat_id, hour, minute], id=f"report-catch-up:{chat_id}", replace_existing=True)
+
+    def shutdown(self):
+        if self._scheduler is not None and self._scheduler.running:
+            self._scheduler.shutdown(wait=False)
+
+    def _add_job(self, chat_id, hour, minute):
+        self._scheduler.add_job(self._fire, 'cron', hour=hour, minute=minute, args=[chat_id, hour, minute],
+                                id=f"report:{chat_id}", replace_existing=True,
+                                coalesce=True, max_instances=1, misfire_grace_time=300)
+
+    # Store a subscriber's report time and (re)schedule the job
+    async def set_time(self, chat_id, hour, minute):
+        await self.db.execute('''INSERT INTO report_times (chat_id, hour, minute) VALUES (?, ?, ?)
+                                 ON CONFLICT(chat_id) DO UPDATE SET hour = excluded.hour, minute = excluded.minute''',
+                              (chat_id, hour, minute))
+        self.times[chat_id] = (hour, minute)
+        if self._scheduler is not None:
+            self._add_job(chat_id, hour, minute)
+
+    # Snapshot for a time slot, computed at most once no matter how many reports fire in it
+    async def snapshot(self, hour, minute):
+        key = (ledger.today(), hour, minute)
+        task = self._snapshots.get(key)
+        if task is None or (task.done() and task.exception() is not None):
+            # Forget slots of previous days
+            for old in [k for k in self._snapshots if k[0] != key[0]]:
+                del self._snapshots[old]
+            task = asyncio.ensure_future(self.build_snapshot(self._bot))
+            self._snapshots[key] = task
+            self.snapshots_built += 1
+        return await asyncio.shield(task)
+
+    async def _fire(self, chat_id, hour, minute):
+        today = ledger.today()
+        if self.last_sent.get(chat_id) == today or self.times.get(chat_id) != (hour, minute) or chat_id in self._sending:
+            return  # Already sent today, the time was changed in the meantime, or an overlapping run is sending it
+        self._sending.add(chat_id)
+        try:
+            snapshot = await self.snapshot(hour, minute)
+            await self.send_report(self._bot, chat_id, snapshot)
+        except Exception as e:
+            logging.error(f"Failed to send daily report to {chat_id}: {str(e)}")
+            return
+        finally:
+            self._sending.discard(chat_id)
+        self.last_sent[chat_id] = today
+        self.reports_sent += 1
+        await self.db.execute("UPDATE report_times SET last_sent_day = ? WHERE chat_id = ?", (today, chat_id))
+
+    def stats(self):
+        return {
+            'subscribers': len(self.times),
+            'snapshots_built': self.snapshots_built,
+            'reports_sent': self.reports_sent,
+        }
@@ -0,0 +1,236 @@
+import asyncio
+import csv
+import gzip
+import io
+import itertools
+import logging
+import os
+import secrets
+import sqlite3
+from datetime import datetime, timedelta
+
+import ledger
+import metrics
+
+# Rows moved per batch; every batch is one short write transaction
+BATCH_SIZE = 2000
+# Free pages handed back to the file system per incremental vacuum step (4 MB with the default page size)
+VACUUM_PAGES = 1024
+
+HEADER = ["ID", "Amount", "Date", "Category", "Chat ID"]
+
+
+# Directory of a database's archive files, e.g. transactions.archive next to transactions.db
+def archive_dir(db_path):
+    root = db_path[:-3] if db_path.endswith('.db') else db_path
+    return root + '.archive'
+
+
+# Archive files are stored relative to the database's directory, so the database and its archive can be moved together
+def _resolve(db_path, file):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), file)
+
+
+# Append one gzip member after the committed part of a file and make it durable, returns the new committed size.
+# Anything after `committed` was written by a batch whose transaction never committed, and is dropped.
+def _append_member(path, committed, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab'):
+        pass
+    with open(path, 'r+b') as file:
+        file.truncate(committed)
+        file.seek(committed)
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    return committed + len(data)
+
+
+def _encode_member(rows, header):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    if header:
+        writer.writerow(HEADER)
+    writer.writerows((id, amount, ledger.format_day(day), category, chat_id) for id, amount, day, category, chat_id in rows)
+    return gzip.compress(text.getvalue().encode('utf-8'))
+
+
+# Rows of one chat in the given members, as (id, amount, day, category, chat_id) like the transactions table
+def _read_members(db_path, members, chat_id, start_day, end_day):
+    rows = []
+    for file, offset, size in members:
+        with open(_resolve(db_path, file), 'rb') as archive:
+            archive.seek(offset)
+            data = gzip.decompress(archive.read(size))
+        for record in csv.reader(io.StringIO(data.decode('utf-8'))):
+            if record == HEADER or int(record[4]) != chat_id:
+                continue
+            day = ledger.parse_day(record[2])
+            if (start_day is None or day >= start_day) and (end_day is None or day <= end_day):
+                rows.append((int(record[0]), float(record[1]), day, record[3], chat_id))
+    rows.sort(key=lambda row: (row[2], row[0]))
+    return rows
+
+
+# Stream a chat's archived transactions one month at a time, in (day, id) order
+async def iter_archived(db, chat_id, start_day=None, end_day=None):
+    members = await db.fetchall('''SELECT month, file, offset, size FROM archive_members
+                                   WHERE chat_id = ? AND month >= ? AND month <= ? ORDER BY month, file, offset''',
+                                (chat_id, (start_day or 0) // 100, (end_day or 99991231) // 100))
+    for _, group in itertools.groupby(members, key=lambda member: member[0]):
+        rows = await asyncio.to_thread(_read_members, db.path, [member[1:] for member in group], chat_id, start_day, end_day)
+        if rows:
+            yield rows
+
+
+# Delete the archived rows and record where they went, in one transaction.
+# Fails if any row is gone already (e.g. /reset ran since the batch was read), so the batch is never half applied.
+def _commit_batch(conn, members):
+    for month, file, offset, size, rows in members:
+        deleted = conn.executemany('DELETE FROM transactions WHERE id = ?', [(row[0],) for row in rows]).rowcount
+        if deleted != len(rows):
+            raise RuntimeError(f"{len(rows) - deleted} row(s) of the batch changed while it was archived")
+
+        daily = {}
+        for _, amount, day, _, chat_id in rows:
+            day_sum, day_count = daily.get((chat_id, day), (0.0, 0))
+            daily[(chat_id, day)] = (day_sum + amount, day_count + 1)
+        conn.executemany('''INSERT INTO archived_totals (chat_id, day, sum, count) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(chat_id, day) DO UPDATE SET sum = sum + excluded.sum, count = count + excluded.count''',
+                         [(chat_id, day, day_sum, day_count) for (chat_id, day), (day_sum, day_count) in daily.items()])
+        conn.executemany('INSERT INTO archive_members (chat_id, month, file, offset, size) VALUES (?, ?, ?, ?, ?)',
+                         [(chat_id, month, file, offset, size) for chat_id in {row[4] for row in rows}])
+        conn.execute('UPDATE archive_files SET bytes = ? WHERE file = ?', (offset + size, file))
+
+
+# One incremental vacuum step, returns the number of free pages left
+def _vacuum_step(conn, pages):
+    # The pragma frees one page per step, so it has to be stepped through to the end
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+# Switch a database file to incremental auto-vacuum. Rewrites the whole file (VACUUM), so run it while the bot is stopped;
+# databases created by this version of the bot already use it.
+def enable_incremental_vacuum(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+
+# Moves transactions older than `retention_days` out of the transactions table into compressed monthly
+# CSV files next to each ledger database (transactions.archive/YYYY-MM-xxxxxxxx.csv.gz).
+# - chat_totals and daily_totals are kept as they are, so totals, /total and /graph don't change;
+#   archived_totals holds the archived sums per chat and day for /verifytotals and /rebuildtotals
+# - rows move in batches of `batch_size`: each batch is appended to the month's file as one gzip member
+#   and fsynced, then deleted from the table in a short transaction that records where it went, so the
+#   write lock is only held for the delete and normal writes get their turn between batches
+# - a batch that fails before its commit leaves nothing behind: the uncommitted tail of the file is cut
+#   off before the next append
+# - freed pages are returned to the file system with incremental vacuum steps afterwards
+# - with shards, every shard archives its own chats into its own files
+class Archiver:
+    def __init__(self, ledger_backend, retention_days=0, interval=6 * 3600, batch_size=BATCH_SIZE, pause=0.05):
+        self.ledger_backend = ledger_backend
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archived = 0
+        self.runs = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    # Archive every `interval` seconds in the background (only when a retention period is configured)
+    def start(self):
+        if self.retention_days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                logging.error(f"Archiving failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    # Archive the transactions of every shard older than `retention_days` (default: the configured period),
+    # returns (rows archived, pages freed)
+    async def run(self, retention_days=None):
+        days = self.retention_days if retention_days is None else retention_days
+        cutoff = ledger.to_day(datetime.now() - timedelta(days=days))
+        async with self._lock:
+            archived = freed = 0
+            for storage in self.ledger_backend.shards:
+                archived += await self._archive(storage, cutoff)
+                freed += await self._vacuum(storage)
+            self.runs += 1
+        if archived:
+            logging.info(f"Archived {archived} transaction(s) from before {ledger.format_day(cutoff)}, freed {freed} page(s)")
+        return archived, freed
+
+    async def _archive(self, db, cutoff):
+        archived = 0
+        after_id = 0
+        while True:
+            rows = await db.fetchall('''SELECT id, amount, day, category, chat_id FROM transactions
+                                        WHERE id > ? AND day < ? AND chat_id IS NOT NULL ORDER BY id LIMIT ?''',
+                                     (after_id, cutoff, self.batch_size))
+            if not rows:
+                return archived
+            after_id = rows[-1][0]
+
+            members = []
+            for month, group in itertools.groupby(sorted(rows, key=lambda row: (row[2] // 100, row[0])), key=lambda row: row[2] // 100):
+                month_rows = list(group)
+                file, committed = await self._month_file(db, month)
+                data = _encode_member(month_rows, header=committed == 0)
+                await asyncio.to_thread(_append_member, _resolve(db.path, file), committed, data)
+                members.append((month, file, committed, len(data), month_rows))
+            await db.transaction(_commit_batch, members)
+
+            archived += len(rows)
+            self.archived += len(rows)
+            metrics.inc('archived_transactions_total', value=len(rows))
+            # Let queued writes through before the next batch
+            await asyncio.sleep(self.pause)
+
+    # The file this database appends a month's rows to, and its committed size
+    async def _month_file(self, db, month):
+        row = await db.fetchone("SELECT file, bytes FROM archive_files WHERE month = ?", (month,))
+        if row is not None:
+            return row
+        # A random suffix keeps the files of different databases (shards, rebalanced layouts) apart
+        file = os.path.join(os.path.basename(archive_dir(db.path)), f"{month // 100:04d}-{month % 100:02d}-{secrets.token_hex(4)}.csv.gz")
+        await db.execute("INSERT INTO archive_files (file, month, bytes) VALUES (?, ?, 0)", (file, month))
+        return file, 0
+
+    async def _vacuum(self, db):
+        if (await db.fetchone("PRAGMA auto_vacuum"))[0] != 2:
+            logging.info(f"{db.path} doesn't use incremental auto-vacuum; run `bot.py --vacuum` once while the bot is stopped to shrink it")
+            return 0
+        freed = 0
+        before = (await db.fetchone("PRAGMA freelist_count"))[0]
+        while before:
+            left = await db.transaction(_vacuum_step, VACUUM_PAGES)
+            if left >= before:
+                break
+            freed += before - left
+            before = left
+            await asyncio.sleep(self.pause)
+        return freed
+
+    def stats(self):
+        return {'retention_days': self.retention_days, 'runs': self.runs, 'archived': self.archived}
@@ -0,0 +1,244 @@
+import asyncio
+import glob
+import logging
+import os
+import re
+import sqlite3
+import zlib
+
+import ledger
+import migrations
+from storage import GroupCommitWriter, Storage
+
+# Per-chat tables; everything else (users, report times, broadcasts, schema version) is global
+# and stays in the main database
+CHAT_TABLES = ('transactions', 'chat_totals', 'daily_totals', 'archived_totals', 'archive_members')
+
+
+# File names of the shards that belong to a main database, e.g. transactions.shard0.db
+def shard_paths(db_path, count):
+    root = db_path[:-3] if db_path.endswith('.db') else db_path
+    return [f"{root}.shard{index}.db" for index in range(count)]
+
+
+# Shard files that exist on disk for a main database, in shard order
+def existing_shard_paths(db_path):
+    root = db_path[:-3] if db_path.endswith('.db') else db_path
+    pattern = re.compile(re.escape(root) + r'\.shard(\d+)\.db$')
+    numbered = []
+    for path in glob.glob(glob.escape(root) + '.shard*.db'):
+        match = pattern.match(path)
+        if match:
+            numbered.append((int(match.group(1)), path))
+    return [path for _, path in sorted(numbered)]
+
+
+# Stable shard number for a chat (crc32, so it doesn't change between runs like hash() does)
+def shard_index(chat_id, count):
+    return zlib.crc32(str(chat_id).encode()) % count
+
+
+# Where the per-chat ledger lives. This default backend keeps everything in the main database;
+# handlers only go through these methods, so a different layout can be plugged in behind them.
+# - storage(chat_id): the Storage holding one chat's rows, for per-chat reads and writes
+# - submit(entry): group-committed transaction entry, as GroupCommitWriter.submit
+# - fetchall_all / read_all / transaction_all: run on every shard (fan-out), results in shard order
+class LedgerBackend:
+    def __init__(self, db, flush_interval=0.005, batch_size=256):
+        self.db = db
+        self.shards = [db]
+        self._writers = [GroupCommitWriter(db, ledger.add_transactions, flush_interval, batch_size)]
+
+    def storage(self, chat_id):
+        return self.db
+
+    def _writer(self, chat_id):
+        return self._writers[0]
+
+    # Refuse to run over a layout that doesn't match the files on disk: chats would be looked up
+    # in the wrong database and their history would seem to be gone
+    def check_layout(self):
+        found = existing_shard_paths(self.db.path)
+        if found:
+            raise RuntimeError(f"Found {len(found)} shard file(s) next to {self.db.path}; start with SHARDS={len(found)} "
+                               f"or run `bot.py --rebalance-shards 1` to move them back into the main database.")
+
+    # Apply the migrations to every database that holds ledger tables
+    def migrate(self):
+        self.check_layout()
+        for shard in self.shards:
+            if shard is not self.db:
+                migrations.migrate(shard)
+
+    # Queue one (chat_id, amount, day, category) entry and wait for the chat's new total
+    async def submit(self, entry):
+        return await self._writer(entry[0]).submit(entry)
+
+    def queue_depth(self):
+        return sum(writer.queue_depth() for writer in self._writers)
+
+    # Rows of a query run on every shard, concatenated
+    async def fetchall_all(self, sql, params=()):
+        results = await asyncio.gather(*(shard.fetchall(sql, params) for shard in self.shards))
+        return [row for rows in results for row in rows]
+
+    # fn(conn, *args) on a reader of every shard, one result per shard
+    async def read_all(self, fn, *args):
+        return await asyncio.gather(*(shard.read(fn, *args) for shard in self.shards))
+
+    # fn(conn, *args) in a write transaction on every shard, one result per shard.
+    # Each shard commits on its own; there is no transaction spanning shards.
+    async def transaction_all(self, fn, *args):
+        return await asyncio.gather(*(shard.transaction(fn, *args) for shard in self.shards))
+
+    # Blocking transaction on every shard, for startup and CLI tools
+    def run_sync_all(self, fn, *args):
+        return [shard.run_sync(fn, *args) for shard in self.shards]
+
+    # Commit what is queued; the shard databases are closed here, the main database by its owner
+    async def close(self):
+        for writer in self._writers:
+            await writer.close()
+        for shard in self.shards:
+            if shard is not self.db:
+                shard.close()
+
+
+# Ledger split over several SQLite files by chat ID.
+# Every shard has its own writer thread and group-commit queue, so entries of chats on different
+# shards are committed in parallel instead of queueing behind the single writer of one file.
+class ShardedBackend(LedgerBackend):
+    def __init__(self, db, paths, readers=2, flush_interval=0.005, batch_size=256):
+        self.db = db
+        self.shards = [Storage(path, readers=readers, synchronous=db.synchronous) for path in paths]
+        self._writers = [GroupCommitWriter(shard, ledger.add_transactions, flush_interval, batch_size) for shard in self.shards]
+
+    def storage(self, chat_id):
+        return self.shards[shard_index(chat_id, len(self.shards))]
+
+    def _writer(self, chat_id):
+        return self._writers[shard_index(chat_id, len(self.shards))]
+
+    def check_layout(self):
+        found = existing_shard_paths(self.db.path)
+        expected = [shard.path for shard in self.shards]
+        if found and found != expected:
+            raise RuntimeError(f"Found {len(found)} shard file(s) but SHARDS={len(expected)}; "
+                               f"run `bot.py --rebalance-shards {len(expected)}` first.")
+        # The ledger rows of the main database would be invisible
+        if self.db.run_sync(_has_ledger_rows):
+            raise RuntimeError(f"The main database still holds ledger rows; run `bot.py --rebalance-shards {len(expected)}` "
+                               f"before starting with shards.")
+
+
+def _has_ledger_rows(conn):
+    return any(conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in CHAT_TABLES)
+
+
+def _chat_sums(conn):
+    return dict(conn.execute("SELECT chat_id, total FROM chat_totals").fetchall())
+
+
+def _migrate_file(path):
+    storage = Storage(path, readers=1)
+    try:
+        migrations.migrate(storage)
+    finally:
+        storage.close()
+
+
+# Copy the chats of one source file that belong to shard `index` of `count` into `conn`, in one transaction.
+# Chats the target already has are skipped, so running it again after an interruption doesn't duplicate them.
+def _copy_shard(conn, source, index, count):
+    conn.execute("ATTACH DATABASE ? AS source", (source,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''CREATE TEMP TABLE moved AS SELECT chat_id FROM source.chat_totals
+                        WHERE shard_index(chat_id, ?) = ? AND chat_id NOT IN (SELECT chat_id FROM main.chat_totals)''', (count, index))
+        # In ID order, so every chat's transactions keep their order under their new IDs
+        copied = conn.execute('''INSERT INTO main.transactions (chat_id, amount, day, category)
+                                 SELECT chat_id, amount, day, category FROM source.transactions
+                                 WHERE chat_id IN (SELECT chat_id FROM temp.moved) ORDER BY id''').rowcount
+        conn.execute('''INSERT INTO main.daily_totals (chat_id, day, sum, count)
+                        SELECT chat_id, day, sum, count FROM source.daily_totals WHERE chat_id IN (SELECT chat_id FROM temp.moved)''')
+        conn.execute('''INSERT INTO main.chat_totals (chat_id, total, count, last_activity, name, last_id)
+                        SELECT chat_id, total, count, last_activity, name,
+                               (SELECT MAX(id) FROM main.transactions AS t WHERE t.chat_id = c.chat_id)
+                        FROM source.chat_totals AS c WHERE chat_id IN (SELECT chat_id FROM temp.moved)''')
+        # Archive files stay where they are; the moved chats keep pointing at them
+        conn.execute('''INSERT INTO main.archived_totals (chat_id, day, sum, count)
+                        SELECT chat_id, day, sum, count FROM source.archived_totals WHERE chat_id IN (SELECT chat_id FROM temp.moved)''')
+        conn.execute('''INSERT INTO main.archive_members (chat_id, month, file, offset, size)
+                        SELECT chat_id, month, file, offset, size FROM source.archive_members WHERE chat_id IN (SELECT chat_id FROM temp.moved)''')
+        conn.execute("DROP TABLE temp.moved")
+        conn.execute("COMMIT")
+        return copied
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("DETACH DATABASE source")
+
+
+# Move the ledger of the main database and of any existing shards into `count` shards
+# (count=1 moves everything back into the main database). Run it while the bot is stopped.
+# New shards are written as .new files and checked against the source totals before anything
+# is removed; replaced shard files are kept with a .bak suffix.
+# Transactions get new IDs in their shard; the order of each chat's transactions is kept.
+def rebalance(db_path, count):
+    if count < 1:
+        raise ValueError("The number of shards must be at least 1.")
+    old_paths = existing_shard_paths(db_path)
+    new_paths = [path + '.new' for path in shard_paths(db_path, count)] if count > 1 else [db_path]
+    sources = ([db_path] if count > 1 else []) + old_paths
+    for path in [db_path] + old_paths + new_paths:
+        _migrate_file(path)
+
+    expected = {}
+    for path in [db_path] + old_paths:
+        conn = sqlite3.connect(path)
+        try:
+            expected.update(_chat_sums(conn))
+        finally:
+            conn.close()
+
+    copied = 0
+    actual = {}
+    try:
+        for index, path in enumerate(new_paths):
+            conn = sqlite3.connect(path, isolation_level=None)
+            try:
+                conn.create_function('shard_index', 2, shard_index, deterministic=True)
+                if path != db_path and _has_ledger_rows(conn):
+                    raise RuntimeError(f"{path} is not empty; remove it and run the rebalance again.")
+                for source in sources:
+                    copied += _copy_shard(conn, source, index, count)
+                actual.update(_chat_sums(conn))
+            finally:
+                conn.close()
+        if set(actual) != set(expected) or any(abs(actual[chat_id] - expected[chat_id]) > 1e-6 for chat_id in expected):
+            raise RuntimeError("The copied totals don't match the source; the old files were left in place.")
+    except BaseException:
+        for path in new_paths:
+            if path != db_path and os.path.exists(path):
+                os.remove(path)
+        raise
+
+    # Everything is copied and checked: drop the old copies and move the new shards into place
+    if count > 1:
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for table in CHAT_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    for path in old_paths:
+        os.replace(path, path + '.bak')
+    for path in new_paths:
+        if path != db_path:
+            os.replace(path, path[:-len('.new')])
+    logging.info(f"Moved {copied} transaction(s) of {len(expected)} chat(s) into {count} shard(s)")
+    return len(expected), copied
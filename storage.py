@@ -0,0 +1,192 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Values of PRAGMA synchronous. FULL (SQLite's default) fsyncs every commit; NORMAL skips that in WAL mode,
+# which is faster but a power loss can undo the last commits.
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+# Short, stable label for a query (a statement or the function running a transaction), for timings
+@functools.lru_cache(maxsize=1024)
+def _label(query):
+    if callable(query):
+        return f"{getattr(query, '__module__', '')}.{getattr(query, '__qualname__', repr(query))}"
+    return ' '.join(query.split())[:80]
+
+
+# Async access to the SQLite database.
+# All writes go through one dedicated writer thread (SQLite only allows one writer at a time),
+# reads are spread over a small pool of reader threads. Every thread owns its own connection,
+# and the database runs in WAL mode so readers never block the writer or each other.
+# Nothing here ever touches SQLite on the asyncio event loop itself.
+class Storage:
+    def __init__(self, path, readers=4, synchronous='FULL'):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid synchronous mode {synchronous}, expected one of {', '.join(SYNCHRONOUS_MODES)}.")
+        self.path = path
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        # Optional callback on_query(operation, label, seconds), called after every async database call
+        self.on_query = None
+
+    # Get (or lazily open) the connection that belongs to the current worker thread
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: autocommit, transactions are opened explicitly in _transaction
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # Only takes effect on a new database (before its first table), lets the archiver hand space back
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _run(self, executor, operation, label, fn, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, functools.partial(fn, *args))
+        finally:
+            if self.on_query is not None:
+                self.on_query(operation, label, time.perf_counter() - started)
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _transaction(self, fn, *args):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    # Read a single row
+    async def fetchone(self, sql, params=()):
+        return await self._run(self._readers, 'fetchone', _label(sql), self._fetchone, sql, params)
+
+    # Read all rows
+    async def fetchall(self, sql, params=()):
+        return await self._run(self._readers, 'fetchall', _label(sql), self._fetchall, sql, params)
+
+    # Run fn(conn, *args) on a reader thread, for multi-statement reads
+    async def read(self, fn, *args):
+        return await self._run(self._readers, 'read', _label(fn), lambda: fn(self._connection(), *args))
+
+    # Run a single write statement in its own transaction, returns the number of affected rows
+    async def execute(self, sql, params=()):
+        return await self._run(self._writer, 'execute', _label(sql), self._transaction, lambda conn: conn.execute(sql, params).rowcount)
+
+    # Run a write statement for every parameter set in one transaction
+    async def executemany(self, sql, seq_of_params):
+        return await self._run(self._writer, 'executemany', _label(sql), self._transaction, lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    # Run fn(conn, *args) on the writer thread inside a single transaction and return its result
+    async def transaction(self, fn, *args):
+        return await self._run(self._writer, 'transaction', _label(fn), self._transaction, fn, *args)
+
+    # Blocking variant of transaction(), for use before the event loop is running (startup, CLI tools)
+    def run_sync(self, fn, *args):
+        return self._writer.submit(self._transaction, fn, *args).result()
+
+    # Stop the worker threads and close every connection
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logging.error(f"Failed to close database connection: {str(e)}")
+            self._connections.clear()
+
+
+# Group commit: collects writes from many handlers and applies them in one transaction.
+# A batch is flushed `flush_interval` seconds after its first item arrives, or as soon as it holds
+# `batch_size` items. apply_batch(conn, items) runs on the writer thread and returns one result per item;
+# submit() resolves only after the batch is committed, so callers can rely on their write being durable
+# (with the default synchronous=FULL; with NORMAL a power loss can still undo the last commits).
+class GroupCommitWriter:
+    def __init__(self, db, apply_batch, flush_interval=0.005, batch_size=256):
+        self.db = db
+        self.apply_batch = apply_batch
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+        self.batches = 0
+        self.items = 0
+
+    # Queue one item and wait for its result
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush)
+        return await future
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        # Batches reach the single writer thread in the order they were flushed
+        task = asyncio.ensure_future(self._commit(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _commit(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.db.transaction(self.apply_batch, items)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # Retry one by one so a single bad item doesn't fail everybody else's write
+            logging.error(f"Group commit of {len(batch)} items failed, retrying individually: {str(e)}")
+            for entry in batch:
+                await self._commit([entry])
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    # Flush what is queued and wait for all outstanding batches
+    async def close(self):
+        self._flush()
+        while self._flushes:
+            await asyncio.gather(*list(self._flushes), return_exceptions=True)
@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import itertools
+import string
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+PAGE_SIZE = 20
+# Longer names are cut so a full page always fits into one message
+MAX_NAME_LENGTH = 64
+CALLBACK_PREFIX = 'summary'
+
+# Sort orders of the paged /summary: key -> (column, descending, button label)
+SORTS = {
+    't': ('total', True, "By total"),
+    'n': ('name', False, "By name"),
+    'r': ('last_activity', True, "Recent"),
+}
+
+# SQLite's NOCASE collation only folds ASCII letters; merging the shards' pages has to compare names the same way
+_NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _sort_key(sort, row):
+    chat_id, total, name, last_activity = row
+    value = {'t': total, 'n': name.translate(_NOCASE), 'r': last_activity}[sort]
+    return value, chat_id
+
+
+# One shard's rows after (or, going back, before) the anchor (key, chat_id), in listing order
+async def _shard_page(db, sort, anchor, backward, limit):
+    column, descending, _ = SORTS[sort]
+    ascending = descending == backward
+    order = 'ASC' if ascending else 'DESC'
+    where = f"WHERE ({column}, chat_id) {'>' if ascending else '<'} (?, ?)" if anchor is not None else ""
+    return await db.fetchall(f'''SELECT chat_id, total, name, last_activity FROM chat_totals {where}
+                                 ORDER BY {column} {order}, chat_id {order} LIMIT ?''', (*(anchor or ()), limit))
+
+
+# One page of chat totals in the given sort order, computed on demand: every shard reads at most
+# page_size + 1 rows through the sort order's index, and the shards' rows are merged.
+# anchor is the (key, chat_id) of the last row of the previous page, or going back of the first row of the next one.
+# Returns the rows (chat_id, total, name, last_activity) and whether there are more in that direction.
+async def fetch_page(ledger_backend, sort, anchor=None, backward=False, page_size=PAGE_SIZE):
+    descending = SORTS[sort][1]
+    shards = await asyncio.gather(*(_shard_page(db, sort, anchor, backward, page_size + 1) for db in ledger_backend.shards))
+    merged = heapq.merge(*shards, key=lambda row: _sort_key(sort, row), reverse=descending != backward)
+    rows = list(itertools.islice(merged, page_size + 1))
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+    return rows, more
+
+
+# Callback data of a page button (at most 64 bytes, as Telegram requires). The anchor's key is included:
+# a name as "=name" when it fits, otherwise it is left empty and looked up again from the anchor chat.
+def callback_data(sort, page, row=None, backward=False):
+    if row is None:
+        return f"{CALLBACK_PREFIX}:{sort}:{page}"
+    data = f"{CALLBACK_PREFIX}:{sort}:{page}:{'p' if backward else 'n'}:{row[0]}:"
+    if sort != 'n':
+        return data + repr(_sort_key(sort, row)[0])
+    named = f"{data}={row[2]}"
+    return named if len(named.encode('utf-8')) <= 64 else data
+
+
+# Parse callback data back into (sort, page, anchor chat_id, anchor key, backward); raises ValueError if malformed
+def parse_callback(data):
+    parts = data.split(':', 5)
+    if parts[0] != CALLBACK_PREFIX or len(parts) not in (3, 6) or parts[1] not in SORTS:
+        raise ValueError(f"Invalid summary callback: {data}")
+    sort, page = parts[1], max(int(parts[2]), 1)
+    if len(parts) == 3:
+        return sort, page, None, None, False
+    chat_id = int(parts[4])
+    if sort == 'n':
+        key = parts[5][1:] if parts[5].startswith('=') else None
+    else:
+        key = float(parts[5]) if sort == 't' else int(parts[5])
+    return sort, page, chat_id, key, parts[3] == 'p'
+
+
+# Store display names with the chat totals (runs in a transaction); only rows whose name changed are written
+def store_names(conn, names):
+    conn.executemany("UPDATE chat_totals SET name = ? WHERE chat_id = ? AND name <> ? COLLATE BINARY",
+                     [(name, chat_id, name) for chat_id, name in names.items()])
+
+
+# Chats whose name was never stored (their name is ''); they need one before a page is read in name
+# order, or they would sort before every anchor and never be reached
+async def unnamed_chats(ledger_backend):
+    rows = await ledger_backend.fetchall_all("SELECT chat_id FROM chat_totals WHERE name = ''")
+    return [chat_id for chat_id, in rows]
+
+
+# Message text of one page, numbered from the page's position
+def format_page(rows, names, sort, page, page_size=PAGE_SIZE):
+    first = (page - 1) * page_size + 1
+    title = f"Summary of Transactions Across All Chats ({SORTS[sort][2].lower()}, {first}-{first + len(rows) - 1}):"
+    lines = []
+    for chat_id, total, _, _ in rows:
+        name = names.get(chat_id, str(chat_id))
+        if len(name) > MAX_NAME_LENGTH:
+            name = name[:MAX_NAME_LENGTH - 1] + '…'
+        lines.append(f"{name} (ID: {chat_id}) - Total: {total}")
+    return title + "\n\n" + "\n".join(lines)
+
+
+# Prev/next buttons for the page and one button per sort order (the current one marked)
+def keyboard(rows, sort, page, has_prev, has_next):
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("« Prev", callback_data=callback_data(sort, page - 1, rows[0], backward=True)))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=callback_data(sort, page + 1, rows[-1])))
+    sorts = [InlineKeyboardButton(("• " if key == sort else "") + label, callback_data=callback_data(key, 1))
+             for key, (_, _, label) in SORTS.items()]
+    return InlineKeyboardMarkup([navigation, sorts] if navigation else [sorts])